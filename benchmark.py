@@ -0,0 +1,243 @@
+"""benchmarks of the ingest and query paths of the pipeline
+
+generates synthetic csv, json and excel files, loads them in temporary sqlite databases and measures the
+throughput of each case, then its peak memory (tracemalloc) in a separate run since tracing slows it down,
+everything runs offline in a temporary folder
+    python benchmark.py --rows 200000 --cols 10 --output results.json
+    python benchmark.py --cases csv_ingest split_ingest --compare results.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+
+WORDS = np.array(['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet'])
+
+
+def make_dataframe(rows, cols, seed=0, tags=3):
+    """
+    builds a synthetic dataframe: an id, a date, a tags column (tags words joined by ';', for the split cases)
+    and cols more columns cycling through floats, integers and words
+    :param rows: the number of rows -> int
+    :param cols: the number of generated columns besides id, date and tags -> int
+    :param seed: the seed of the random generator, the same seed gives the same data -> int
+    :param tags: the number of words in the tags column -> int
+    :return: pandas.DataFrame object
+    """
+    rng = np.random.default_rng(seed)
+    data = {
+        'Id': np.arange(rows),
+        'date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D'),
+        'Tags': pd.Series(WORDS[rng.integers(0, len(WORDS), rows)])
+    }
+    for _ in range(1, tags):
+        data['Tags'] = data['Tags'] + ';' + WORDS[rng.integers(0, len(WORDS), rows)]
+    for i in range(cols):
+        if i % 3 == 0:
+            data['Amount %d' % i] = rng.normal(100, 25, rows).round(2)
+        elif i % 3 == 1:
+            data['Quantity %d' % i] = rng.integers(0, 1000, rows)
+        else:
+            data['Label %d' % i] = WORDS[rng.integers(0, len(WORDS), rows)]
+    return pd.DataFrame(data)
+
+
+def write_inputs(folder, df, files):
+    """
+    writes the inputs of the cases in folder: input.csv, input.jsonl, input.xlsx and files csv files in
+    folder/parts
+    :return: {'csv': path, 'json': path, 'excel': path, 'folder': path}
+    """
+    paths = {'csv': os.path.join(folder, 'input.csv'), 'json': os.path.join(folder, 'input.jsonl'),
+             'excel': os.path.join(folder, 'input.xlsx'), 'folder': os.path.join(folder, 'parts')}
+    df.to_csv(paths['csv'], index=False)
+    df.to_json(paths['json'], orient='records', lines=True, date_format='iso')
+    df.to_excel(paths['excel'], sheet_name='data', index=False)
+    os.makedirs(paths['folder'])
+    for i, rows in enumerate(np.array_split(np.arange(len(df)), files)):
+        df.iloc[rows].to_csv(os.path.join(paths['folder'], 'part_%03d.csv' % i), index=False)
+    return paths
+
+
+def case_csv_ingest(p, paths, df):
+    p.insert_csv_data_to_sqlite_table(_csv_path=paths['csv'], _table_name='bench')
+
+
+def case_csv_chunked_ingest(p, paths, df):
+    p.insert_csv_data_to_sqlite_table(_csv_path=paths['csv'], _table_name='bench', _chunksize=50000)
+
+
+def case_json_ingest(p, paths, df):
+    p.insert_json_data_to_sqlite_table(_json_path=paths['json'], _table_name='bench', _lines=True)
+
+
+def case_excel_ingest(p, paths, df):
+    p.insert_excel_data_to_sqlite_table(_excel_path=paths['excel'], _sheet_name='data', _table_name='bench')
+
+
+def case_dataframe_bulk_ingest(p, paths, df):
+    p.insert_DataFrame_to_sqlite_table(df.copy(), 'bench', 'benchmark', bulk=True)
+
+
+def case_folder_ingest(p, paths, df):
+    p.insert_files_from_folder_to_sqlite_tables(paths['folder'], '', 'bench')
+
+
+def case_split_ingest(p, paths, df):
+    p.insert_DataFrame_to_sqlite_table(df.copy(), 'bench', 'benchmark', table_split_name='bench_tags',
+                                       list_col_to_split=['tags'], list_splitters=[';'], col_control_id=['id'])
+
+
+def setup_alignment(p, paths, df):
+    p.insert_DataFrame_to_sqlite_table(df.copy(), 'bench_a', 'benchmark')
+    p.insert_DataFrame_to_sqlite_table(df.head(10).copy(), 'bench_b', 'benchmark')
+    p.insert_DataFrame_to_sqlite_table(df.head(10).copy(), 'bench_b', 'benchmark')
+
+
+def case_align_copy(p, paths, df):
+    p._update_upload_ids(['bench_a', 'bench_b'])
+
+
+def case_align_by_reference(p, paths, df):
+    p._update_upload_ids(['bench_a', 'bench_b'], by_reference=True)
+
+
+def setup_query(p, paths, df):
+    p.insert_DataFrame_to_sqlite_table(df.copy(), 'bench', 'benchmark', bulk=True)
+
+
+def case_query_table(p, paths, df):
+    p.fetch_dataframe_using_query(table_name='bench')
+
+
+def case_query_aggregate(p, paths, df):
+    p.fetch_dataframe_using_query('SELECT label_2, count(*) AS n, sum(quantity_1) AS quantity FROM bench '
+                                  'GROUP BY label_2')
+
+
+def setup_query_cached(p, paths, df):
+    setup_query(p, paths, df)
+    p.enable_query_cache()
+    case_query_table(p, paths, df)
+
+
+# name: (the measured function, the function preparing the database before it or None)
+CASES = {
+    'csv_ingest': (case_csv_ingest, None),
+    'csv_chunked_ingest': (case_csv_chunked_ingest, None),
+    'json_ingest': (case_json_ingest, None),
+    'excel_ingest': (case_excel_ingest, None),
+    'dataframe_bulk_ingest': (case_dataframe_bulk_ingest, None),
+    'folder_ingest': (case_folder_ingest, None),
+    'split_ingest': (case_split_ingest, None),
+    'align_copy': (case_align_copy, setup_alignment),
+    'align_by_reference': (case_align_by_reference, setup_alignment),
+    'query_table': (case_query_table, setup_query),
+    'query_aggregate': (case_query_aggregate, setup_query),
+    'query_table_cached': (case_query_table, setup_query_cached),
+}
+
+
+def run_once(name, paths, df, db_path, low_memory=False, traced=False):
+    """
+    runs a case once against a new database, the setup isn't measured
+    :param traced: measures the peak memory with tracemalloc instead of the time, tracing slows the case down
+    too much for its time to mean anything -> bool
+    :return: the seconds taken, or the peak memory in bytes when traced
+    """
+    func, setup = CASES[name]
+    with pipeline.Pipeline(db_path, low_memory=low_memory) as p, contextlib.redirect_stdout(io.StringIO()):
+        if setup is not None:
+            setup(p, paths, df)
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        func(p, paths, df)
+        measure = time.perf_counter() - start
+        if traced:
+            measure = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    os.remove(db_path)
+    return measure
+
+
+def run_case(name, paths, df, folder, repeat, low_memory=False):
+    """
+    runs a case repeat times untraced for its time, then once more under tracemalloc for its peak memory, each
+    time against a new database
+    :return: {'case', 'rows', 'seconds' (median), 'min_seconds', 'rows_per_sec', 'peak_mb'}
+    """
+    timings = [run_once(name, paths, df, os.path.join(folder, '%s_%d.db' % (name, i)), low_memory)
+               for i in range(repeat)]
+    peak = run_once(name, paths, df, os.path.join(folder, '%s_traced.db' % name), low_memory, traced=True)
+    seconds = statistics.median(timings)
+    return {'case': name, 'rows': len(df), 'seconds': seconds, 'min_seconds': min(timings),
+            'rows_per_sec': len(df) / seconds if seconds else None, 'peak_mb': peak / 2 ** 20}
+
+
+def compare(results, previous_path):
+    """
+    prints the speed and memory ratios of the results against a previous results file, > 1 is better
+    """
+    with open(previous_path) as f:
+        previous = {result['case']: result for result in json.load(f)['results']}
+    print('%-24s %10s %10s' % ('case', 'speedup', 'memory'))
+    for result in results:
+        old = previous.get(result['case'])
+        if old is not None:
+            print('%-24s %9.2fx %9.2fx' % (result['case'], old['seconds'] / result['seconds'],
+                                           old['peak_mb'] / result['peak_mb'] if result['peak_mb'] else 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks of the pipeline ingest and query paths')
+    parser.add_argument('--rows', type=int, default=100000, help='the rows of the generated inputs')
+    parser.add_argument('--cols', type=int, default=10, help='the generated columns besides id, date and tags')
+    parser.add_argument('--tags', type=int, default=3, help='the words of the split column')
+    parser.add_argument('--files', type=int, default=10, help='the files of the folder ingest')
+    parser.add_argument('--repeat', type=int, default=3, help='the runs of each case, the median is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--low-memory', action='store_true', help='runs the pipeline in low_memory mode')
+    parser.add_argument('--output', default='', help='writes the results to this json file')
+    parser.add_argument('--compare', default='', help='a previous json results file to compare with')
+    args = parser.parse_args(argv)
+    df = make_dataframe(args.rows, args.cols, args.seed, args.tags)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_inputs(folder, df, args.files)
+        for name in args.cases:
+            result = run_case(name, paths, df, folder, args.repeat, args.low_memory)
+            results.append(result)
+            print('%-24s %8.3fs %12.0f rows/s %9.1f MB' % (name, result['seconds'], result['rows_per_sec'] or 0,
+                                                           result['peak_mb']))
+    report = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': vars(args),
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                        'sqlite': sqlite3.sqlite_version, 'platform': platform.platform()},
+        'results': results
+    }
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare != '':
+        compare(results, args.compare)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,1450 @@
 """main module"""
 
+import argparse
+import asyncio
 import sqlite3
 import os
+import sys
 import datetime
+import time
+import threading
+import contextlib
+import concurrent.futures
+import getpass
+import hashlib
+import json
+import functools
+import collections
+import math
 import yaml
 import regex as re
+import numpy as np
 import pandas as pd
 import unidecode
-import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import python_calamine
+except ImportError:
+    python_calamine = None
+
+# pragmas switched on for the duration of a bulk load (see insert_DataFrame_to_sqlite_table), restored afterwards
+BULK_LOAD_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -262144}
+
+CONTROL_TABLE_DDL = '''CREATE TABLE IF NOT EXISTS control_table (
+"control_id" PRIMARY KEY,
+  "source_file" TEXT,
+  "upload" INTEGER,
+  "insert_date" TIMESTAMP,
+  "user_id" TEXT,
+  "table_name" TEXT,
+  "reference_control_id" TEXT,
+  "rows_inserted" INTEGER,
+  "rows_updated" INTEGER,
+  "rows_unchanged" INTEGER,
+  "rows_quarantined" INTEGER
+);'''
+CONTROL_TABLE_INDEX_DDL = '''CREATE INDEX IF NOT EXISTS control_table_table_name_upload
+ON control_table (table_name, upload);'''
+
+# tables of the pipeline itself, they don't get the control_id index nor the latest view of the data tables
+INTERNAL_TABLES = ('control_table', 'file_manifest', 'run_metrics', 'shard_map')
+
+FILE_MANIFEST_DDL = '''CREATE TABLE IF NOT EXISTS file_manifest (
+"control_id" TEXT,
+  "table_name" TEXT,
+  "file_path" TEXT,
+  "size" INTEGER,
+  "mtime" REAL,
+  "hash" TEXT,
+  "insert_date" TIMESTAMP
+);'''
+RUN_METRICS_DDL = '''CREATE TABLE IF NOT EXISTS run_metrics (
+"run_id" TEXT,
+  "stage" TEXT,
+  "table_name" TEXT,
+  "start_date" TIMESTAMP,
+  "seconds" REAL,
+  "rows" INTEGER,
+  "bytes" INTEGER,
+  "sql_statements" INTEGER,
+  "sql_seconds" REAL
+);'''
+# the key of the parquet metadata holding the table, types and control_table rows of a snapshot (see export_snapshot)
+SNAPSHOT_METADATA_KEY = b'pipeline_snapshot'
+
+# the rows failing the validation rules of a load go to <table_name>_quarantine (see Pipeline._validate_dataframe)
+QUARANTINE_SUFFIX = '_quarantine'
+# the validation of the folder loads having a date column when none is given
+FOLDER_DATE_VALIDATION = {'date': {'type': 'date'}}
+
+# the shard file holding each table of a sharded layout, in the catalog database (see ShardedPipeline)
+SHARD_MAP_DDL = '''CREATE TABLE IF NOT EXISTS shard_map (
+"table_name" TEXT PRIMARY KEY,
+  "shard" TEXT
+);'''
+
+FILE_MANIFEST_INDEX_DDL = '''CREATE INDEX IF NOT EXISTS file_manifest_table_name_file_path
+ON file_manifest (table_name, file_path);'''
+
+# splits a column name on underscores and non alphanumeric characters, see Pipeline._field_name_to_db_format
+FIELD_NAME_SPLIT_PATTERN = re.compile(r'[_\W]+')
+
+# rows converted and sent per executemany call in low_memory mode when no chunksize is given
+LOW_MEMORY_CHUNKSIZE = 20000
+
+# the names accepted for the column types of a schema (see Pipeline._get_schema), any other name is used as is
+SCHEMA_TYPE_ALIASES = {'int': 'INTEGER', 'integer': 'INTEGER', 'float': 'REAL', 'real': 'REAL', 'str': 'TEXT',
+                       'text': 'TEXT', 'numeric': 'NUMERIC', 'blob': 'BLOB', 'date': 'TIMESTAMP',
+                       'datetime': 'TIMESTAMP', 'timestamp': 'TIMESTAMP'}
+# number of non null values looked at to infer the type of a text column
+SCHEMA_SAMPLE_ROWS = 10000
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm', '.xls', '.xlsb', '.ods')
+CSV_EXTENSIONS = ('.csv',)
+JSON_EXTENSIONS = ('.json', '.jsonl')
+
+
+def _read_folder_file(file_path, sheet_name, collision_policy='suffix', low_memory=False, excel_engine=''):
+    """
+    reads one file of a folder ingestion according to its extension and formats its column names,
+    module level so it can be sent to the worker processes of insert_files_from_folder_to_sqlite_tables
+    :param file_path: the path of the file -> str
+    :param sheet_name: the sheet to read for excel files -> str
+    :param collision_policy: see Pipeline._format_column_names -> str
+    :param low_memory: shrinks the dtypes of the dataframe, see Pipeline._shrink_dataframe -> bool
+    :param excel_engine: see Pipeline._get_excel_engine -> str
+    :return: pandas.DataFrame object
+    """
+    extension = Pipeline.get_extension_from_file(file_path).lower()
+    if extension in EXCEL_EXTENSIONS:
+        df = Pipeline._read_excel(file_path, sheet_name, engine=excel_engine)
+    elif extension in CSV_EXTENSIONS:
+        df = pd.read_csv(file_path, sep=',')
+    else:
+        df = pd.read_json(file_path, lines=extension == '.jsonl')
+    df.columns = Pipeline._format_column_names(list(df), collision_policy)
+    if low_memory:
+        Pipeline._shrink_dataframe(df)
+    return df
+
+
+def _read_folder_header(file_path, sheet_name, collision_policy='suffix', excel_engine=''):
+    """
+    reads only the formatted column names of a file of a folder ingestion, the csv and excel files are read
+    without their rows, the json files have to be parsed entirely
+    :return: list
+    """
+    extension = Pipeline.get_extension_from_file(file_path).lower()
+    if extension in EXCEL_EXTENSIONS:
+        columns = list(pd.read_excel(file_path, sheet_name or 0, nrows=0,
+                                     engine=Pipeline._get_excel_engine(excel_engine)))
+    elif extension in CSV_EXTENSIONS:
+        columns = list(pd.read_csv(file_path, sep=',', nrows=0))
+    else:
+        columns = list(pd.read_json(file_path, lines=extension == '.jsonl'))
+    return Pipeline._format_column_names(columns, collision_policy)
+
+
+# the workbook opened by a worker process of insert_excel_data_to_sqlite_table, kept for its next sheets
+_WORKBOOKS = {}
+
+
+def _read_excel_in_worker(excel_path, sheet_name='', list_column_rename='', skiprows='', engine=''):
+    """
+    Pipeline._read_excel for the worker processes of insert_excel_data_to_sqlite_table, a workbook is opened
+    once per worker and reused for the next sheets of the file the worker gets, only the workbook of the file
+    being read is kept open
+    """
+    for path in [path for path in _WORKBOOKS if path != excel_path]:
+        _WORKBOOKS.pop(path).close()
+    return Pipeline._read_excel(excel_path, sheet_name, list_column_rename, skiprows, engine, _WORKBOOKS)
+
+
+def _iter_in_processes(calls, workers):
+    """
+    runs the calls in a pool of workers processes and yields their results in order, no more than workers calls
+    are submitted ahead of the result being consumed so only workers results are held in memory
+    :param calls: the functions to run, module level so they can be sent to the processes -> list of
+    functools.partial objects
+    :param workers: the number of processes -> int
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for call in calls:
+            pending.append(executor.submit(call))
+            if len(pending) == workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _identity(value):
+    """
+    returns the value passed, used to hand an already parsed dataframe to the readers' call sites
+    """
+    return value
+
+
+def _timed_call(func):
+    """
+    calls func in an executor and returns its result with the date it started at and the seconds it took, for the
+    stages run outside of the pipeline (see AsyncPipeline._load)
+    """
+    start_date = datetime.datetime.now()
+    start = time.perf_counter()
+    result = func()
+    return result, start_date, time.perf_counter() - start
+
+
+class _QueryCache:
+    """
+    LRU cache of query results used by Pipeline.fetch_dataframe_using_query, bounded in number of entries and in
+    bytes. The results of at least disk_min_bytes are kept as feather files in disk_dir instead of memory
+    (requires pyarrow), in their own LRU bounded by max_disk_bytes
+    """
+    def __init__(self, max_entries=128, max_bytes=256 * 2 ** 20, disk_dir='', disk_min_bytes=64 * 2 ** 20,
+                 max_disk_bytes=4 * 2 ** 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_min_bytes = disk_min_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = collections.OrderedDict()
+        self._disk = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir != '':
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        :return: a copy of the cached dataframe, None if the key isn't cached
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0].copy()
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                path = self._disk[key][0]
+            else:
+                return None
+        return pd.read_feather(path)
+
+    def put(self, key, tables, df):
+        """
+        :param key: the cache key (query, versions), replaces the entries of older versions of the query -> tuple
+        :param tables: the tables the query reads, see invalidate -> set
+        :param df: the result of the query -> pandas.DataFrame object
+        """
+        with self._lock:
+            for entries in (self._memory, self._disk):
+                for stale_key in [stale_key for stale_key in entries if stale_key[0] == key[0]]:
+                    self._evict(entries, stale_key)
+        size = int(df.memory_usage(deep=True).sum())
+        if self.disk_dir != '' and size >= self.disk_min_bytes:
+            if size > self.max_disk_bytes:
+                return
+            path = os.path.join(self.disk_dir, '%s.feather' % hashlib.sha256(repr(key).encode()).hexdigest())
+            df.reset_index(drop=True).to_feather(path)
+            size = os.path.getsize(path)
+            with self._lock:
+                self._disk[key] = (path, tables, size)
+                self._disk_bytes += size
+                while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                    self._evict(self._disk, next(iter(self._disk)))
+            return
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._memory[key] = (df.copy(), tables, size)
+            self._memory_bytes += size
+            while (self._memory_bytes > self.max_bytes or len(self._memory) > self.max_entries) \
+                    and len(self._memory) > 1:
+                self._evict(self._memory, next(iter(self._memory)))
+
+    def _evict(self, entries, key):
+        value, tables, size = entries.pop(key)
+        if entries is self._disk:
+            self._disk_bytes -= size
+            if os.path.exists(value):
+                os.remove(value)
+        else:
+            self._memory_bytes -= size
+
+    def invalidate(self, tables=None):
+        """
+        drops the entries reading one of the tables given, every entry if None
+        :param tables: the names of the tables whose data changed -> iterable
+        """
+        with self._lock:
+            for entries in (self._memory, self._disk):
+                for key in [key for key, value in entries.items() if tables is None or value[1] & set(tables)]:
+                    self._evict(entries, key)
+
+
+class _RenamedChunks:
+    """
+    wraps a pandas chunk reader to rename the columns of every chunk it yields
+    """
+    def __init__(self, reader, columns):
+        self.reader = reader
+        self.columns = columns
+
+    def __iter__(self):
+        for chunk in self.reader:
+            chunk.columns = self.columns
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reader.close()
+
+
+class RunMetrics:
+    """
+    the measures of a profiled run (see Pipeline.profile): one event per stage executed (read, format_columns,
+    control_table, split, write, query) with its duration, rows, bytes and, when the sql is traced, the number
+    of sqlite statements it ran and their time. The time of a statement is measured until the next statement
+    of the same thread starts or the stage ends, so it includes the python work in between (e.g. the
+    conversion of the rows sent by executemany)
+    """
+    def __init__(self, run_id, trace_sql=False):
+        self.run_id = run_id
+        self.trace_sql = trace_sql
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.events = []
+        self.statements = collections.defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add_event(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def add_statement(self, stage, kind, seconds):
+        with self._lock:
+            counts = self.statements[(stage, kind)]
+            counts[0] += 1
+            counts[1] += seconds
+
+    def report(self):
+        """
+        :return: the events summed up by stage: calls, seconds, rows, bytes, rows_per_sec, sql_statements and
+        sql_seconds, the slowest stage first -> pandas.DataFrame object
+        """
+        columns = ['stage', 'seconds', 'rows', 'bytes', 'sql_statements', 'sql_seconds']
+        events = pd.DataFrame([[event[col] for col in columns] for event in self.events], columns=columns)
+        report = events.groupby('stage').agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+                                             rows=('rows', 'sum'), bytes=('bytes', 'sum'),
+                                             sql_statements=('sql_statements', 'sum'),
+                                             sql_seconds=('sql_seconds', 'sum'))
+        report.insert(4, 'rows_per_sec', report['rows'] / report['seconds'].where(report['seconds'] > 0))
+        return report.sort_values('seconds', ascending=False)
+
+    def statements_report(self):
+        """
+        :return: the traced sqlite statements by stage and kind (INSERT, SELECT, ...): count and seconds
+        -> pandas.DataFrame object
+        """
+        return pd.DataFrame([[stage, kind, count, seconds] for (stage, kind), (count, seconds)
+                             in self.statements.items()],
+                            columns=['stage', 'statement', 'count', 'seconds']).sort_values('seconds',
+                                                                                             ascending=False)
+
+    def summary(self):
+        """
+        :return: the report of the run as text
+        """
+        text = 'run %s: %.2fs\n%s' % (self.run_id, self.seconds or time.perf_counter() - self.start,
+                                      self.report().to_string())
+        if self.statements:
+            text += '\n' + self.statements_report().to_string(index=False)
+        return text
 
 
 class Pipeline:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pragmas=None, timeout=5.0, column_collision_policy='suffix', upload_column=False,
+                 low_memory=False, excel_engine=''):
+        """
+        :param db_path: the path of the sqlite database -> str
+        :param pragmas: the pragmas applied to every connection opened by the pipeline,
+        e.g. {'journal_mode': 'WAL', 'cache_size': -64000} -> dict
+        :param timeout: how many seconds a connection waits for a lock before raising -> float
+        :param column_collision_policy: what to do when two column names of a file are the same once formatted,
+        'suffix' or 'error' (see _format_column_names) -> str
+        :param upload_column: if True the data tables get an indexed integer upload column next to the control_id,
+        convenient to filter uploads by range -> bool
+        :param low_memory: keeps as little data in memory as possible during the loads: the integer columns of the
+        files read are downcast and their repetitive text columns made categorical, the control_id, Source and split
+        columns are categorical, the rows are converted and written by chunks of LOW_MEMORY_CHUNKSIZE and the folder
+        loads are streamed file by file -> bool
+        :param excel_engine: the engine reading the excel files, see _get_excel_engine -> str
+        """
         self.db_path = db_path
+        self.pragmas = dict(pragmas) if pragmas else {}
+        self.timeout = timeout
+        self.column_collision_policy = column_collision_policy
+        self.upload_column = upload_column
+        self.low_memory = low_memory
+        self.excel_engine = excel_engine
+        self._query_cache = None
+        self._metrics = None
+        self._hooks = []
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Connection management
+    def _get_connection(self):
+        """
+        returns the connection of the current thread, the connection is opened on the first call and then reused
+        by every helper until close() is called, each thread gets its own connection since sqlite connections
+        can't be shared between threads
+        :return: sqlite3.Connection object
+        """
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+            for pragma, value in self.pragmas.items():
+                con.execute('PRAGMA %s = %s;' % (pragma, value))
+            if self._metrics is not None and self._metrics.trace_sql:
+                con.set_trace_callback(self._trace_statement)
+            self._local.con = con
+            with self._connections_lock:
+                self._connections.append(con)
+        return con
+
+    def close(self):
+        """
+        commits and closes every connection opened by the pipeline, the pipeline can still be used afterwards,
+        new connections will be opened when needed
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for con in connections:
+            con.commit()
+            con.close()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        groups every write made inside the with block in a single transaction, committed once at the end
+        or rolled back entirely if an exception is raised, transactions can be nested: only the outermost
+        one commits
+            with pipeline.transaction():
+                pipeline.insert_DataFrame_to_sqlite_table(df_a, 'table_a', 'a.csv')
+                pipeline.insert_DataFrame_to_sqlite_table(df_b, 'table_b', 'b.csv')
+        """
+        con = self._get_connection()
+        self._get_metadata()
+        depth = getattr(self._local, 'transaction_depth', 0)
+        if depth == 0:
+            if con.in_transaction:
+                con.commit()
+            con.execute('BEGIN IMMEDIATE;')
+        self._local.transaction_depth = depth + 1
+        try:
+            yield con
+        except BaseException:
+            self._local.transaction_depth = depth
+            if depth == 0:
+                con.rollback()
+                self._invalidate_metadata()
+            raise
+        self._local.transaction_depth = depth
+        if depth == 0:
+            con.commit()
+
+    @contextlib.contextmanager
+    def _temporary_pragmas(self, pragmas):
+        """
+        applies the pragmas given for the duration of the with block and restores their previous values afterwards,
+        journal_mode can't be changed inside a transaction so the block must be entered outside of one
+        :param pragmas: e.g. {'journal_mode': 'WAL', 'synchronous': 'OFF'} -> dict
+        """
+        con = self._get_connection()
+        previous = {pragma: con.execute('PRAGMA %s;' % pragma).fetchone()[0] for pragma in pragmas}
+        for pragma, value in pragmas.items():
+            con.execute('PRAGMA %s = %s;' % (pragma, value))
+        try:
+            yield
+        finally:
+            for pragma, value in previous.items():
+                con.execute('PRAGMA %s = %s;' % (pragma, value))
+
+    def _in_transaction(self):
+        """
+        :return: True if the current thread is inside a transaction() block
+        """
+        return getattr(self._local, 'transaction_depth', 0) > 0
+
+    # Instrumentation
+    def add_hook(self, callback):
+        """
+        registers a function called at the end of every stage (read, format_columns, control_table, split, write,
+        query) with the event of the stage: {'run_id', 'stage', 'table_name', 'start_date', 'seconds', 'rows',
+        'bytes', 'sql_statements', 'sql_seconds'}, e.g. to send the timings to a monitoring system.
+        The hooks are called from the thread running the stage
+        :param callback: the function, called with the event -> callable
+        """
+        self._hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self._hooks.remove(callback)
+
+    @contextlib.contextmanager
+    def profile(self, run_id='', trace_sql=False, persist=False, print_summary=True):
+        """
+        measures the stages of everything the pipeline does inside the with block
+            with pipeline.profile('nightly', trace_sql=True, persist=True) as metrics:
+                pipeline.insert_csv_data_to_sqlite_table('config.yaml')
+            metrics.report()
+        :param run_id: the name of the run, the start date if '' -> str
+        :param trace_sql: counts and times the sqlite statements with set_trace_callback, each row sent by an
+        executemany counts as one statement so it slows big loads down a little -> bool
+        :param persist: writes the events to the run_metrics table at the end of the run -> bool
+        :param print_summary: prints the report at the end of the run -> bool
+        :return: RunMetrics object
+        """
+        metrics = RunMetrics(run_id or datetime.datetime.now().isoformat(sep=' ', timespec='seconds'), trace_sql)
+        previous, self._metrics = self._metrics, metrics
+        if trace_sql:
+            with self._connections_lock:
+                for con in self._connections:
+                    con.set_trace_callback(self._trace_statement)
+        try:
+            yield metrics
+        finally:
+            self._metrics = previous
+            if trace_sql:
+                with self._connections_lock:
+                    for con in self._connections:
+                        con.set_trace_callback(self._trace_statement if previous is not None and previous.trace_sql
+                                               else None)
+            metrics.seconds = time.perf_counter() - metrics.start
+            if persist:
+                self._write_run_metrics(metrics)
+            if print_summary:
+                print(metrics.summary())
+
+    @contextlib.contextmanager
+    def _stage(self, stage, table_name='', rows=0, bytes_=0):
+        """
+        times the with block as a stage of the current run, the block can fill the rows and bytes of the event
+        it gets, and its start_date and seconds when the work was measured elsewhere (e.g. a parse in an
+        executor). Costs nothing when no run is profiled and no hook is registered
+        :param stage: the name of the stage -> str
+        :param table_name: the table the stage works on -> str
+        :return: the event of the stage -> dict
+        """
+        event = {'rows': rows, 'bytes': bytes_}
+        metrics = self._metrics
+        if metrics is None and not self._hooks:
+            yield event
+            return
+        event.update({'run_id': metrics.run_id if metrics is not None else None, 'stage': stage,
+                      'table_name': table_name, 'start_date': datetime.datetime.now(),
+                      'sql_statements': 0, 'sql_seconds': 0.0})
+        parent = getattr(self._local, 'stage', None)
+        self._local.stage = event
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            self._close_statement()
+            event.setdefault('seconds', time.perf_counter() - start)
+            self._local.stage = parent
+            if metrics is not None:
+                metrics.add_event(event)
+            for hook in self._hooks:
+                hook(event)
+
+    def _trace_statement(self, statement):
+        """
+        trace callback of the connections while a run is profiled with trace_sql, the previous statement of the
+        thread ends when the next one starts
+        """
+        self._close_statement()
+        event = getattr(self._local, 'stage', None)
+        self._local.statement = (event, statement.lstrip().split(None, 1)[0].upper() if statement.strip() else '',
+                                 time.perf_counter())
+
+    def _close_statement(self):
+        """
+        adds the statement of the thread still running to its stage and to the run
+        """
+        statement = getattr(self._local, 'statement', None)
+        metrics = self._metrics
+        if statement is None or metrics is None:
+            return
+        self._local.statement = None
+        event, kind, start = statement
+        seconds = time.perf_counter() - start
+        if event is not None:
+            event['sql_statements'] += 1
+            event['sql_seconds'] += seconds
+        metrics.add_statement(event['stage'] if event is not None else None, kind, seconds)
+
+    def _write_run_metrics(self, metrics):
+        """
+        appends the events of a run to the run_metrics table
+        :param metrics: the run -> RunMetrics object
+        """
+        con = self._get_connection()
+        with self.transaction():
+            con.execute(RUN_METRICS_DDL)
+            con.executemany(
+                '''INSERT INTO run_metrics (run_id, stage, table_name, start_date, seconds, rows, bytes, sql_statements,
+                sql_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                [(metrics.run_id, event['stage'], event['table_name'], event['start_date'].isoformat(sep=' '),
+                  event['seconds'], event['rows'], event['bytes'], event['sql_statements'], event['sql_seconds'])
+                 for event in metrics.events])
+        self._get_metadata()['tables'].add('run_metrics')
+
+    # Metadata cache
+    def _get_metadata(self):
+        """
+        returns the metadata cache of the current connection: the set of the tables of the database and the latest
+        upload of each table of the control_table. The cache is filled with two queries and kept up to date by the
+        pipeline's own writes, it is reloaded when PRAGMA data_version tells another connection changed the database
+        :return: {'data_version': int, 'tables': set, 'indexes': set, 'views': set, 'latest_uploads': dict,
+        'columns': dict}
+        the declared types of the columns of a table are only loaded the first time they are needed, see
+        _get_table_types
+        """
+        con = self._get_connection()
+        data_version = con.execute('PRAGMA data_version;').fetchone()[0]
+        metadata = getattr(self._local, 'metadata', None)
+        if metadata is None or metadata['data_version'] != data_version:
+            objects = {'table': set(), 'index': set(), 'view': set()}
+            for name, type_ in con.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'index', "
+                                           "'view');"):
+                objects[type_].add(name)
+            tables = objects['table']
+            latest_uploads = {}
+            if 'control_table' in tables:
+                self._upgrade_control_table()
+                latest_uploads = dict(con.execute(
+                    'SELECT table_name, max(upload) FROM control_table GROUP BY table_name;'
+                ).fetchall())
+            metadata = {'data_version': data_version, 'tables': tables, 'indexes': objects['index'],
+                        'views': objects['view'], 'latest_uploads': latest_uploads, 'columns': {}}
+            self._local.metadata = metadata
+        return metadata
+
+    def _invalidate_metadata(self):
+        """
+        drops the metadata cache of the current connection, it will be reloaded on the next lookup
+        """
+        self._local.metadata = None
+
+    def _upgrade_control_table(self):
+        """
+        adds the columns missing from a control_table created by a previous version of the pipeline: table_name,
+        filled from the control_id (table_name + upload), reference_control_id, the merge and quarantine counts,
+        and the (table_name, upload) index
+        """
+        con = self._get_connection()
+        columns = [row[1] for row in con.execute('PRAGMA table_info(control_table);')]
+        if 'table_name' not in columns:
+            con.execute('ALTER TABLE control_table ADD COLUMN table_name TEXT;')
+            con.execute('''UPDATE control_table
+            SET table_name = substr(control_id, 1, length(control_id) - length(CAST(upload AS TEXT)));''')
+        if 'reference_control_id' not in columns:
+            con.execute('ALTER TABLE control_table ADD COLUMN reference_control_id TEXT;')
+        for column in ('rows_inserted', 'rows_updated', 'rows_unchanged', 'rows_quarantined'):
+            if column not in columns:
+                con.execute('ALTER TABLE control_table ADD COLUMN %s INTEGER;' % column)
+        con.execute(CONTROL_TABLE_INDEX_DDL)
+        if not self._in_transaction():
+            con.commit()
+
+    @staticmethod
+    def _dataframe_to_records(df):
+        """
+        converts the rows of a dataframe into tuples of python values sqlite can bind,
+        missing values become None, dates are written as iso strings like pandas.to_sql does
+        :param df: the dataframe to convert -> pandas.DataFrame object
+        :return: list of tuples
+        """
+        return list(zip(*[Pipeline._serie_to_values(df[col]) for col in df.columns]))
+
+    @staticmethod
+    def _serie_to_values(serie):
+        """
+        :param serie: a column of a dataframe -> pandas.Series object
+        :return: the values of the column as they are bound to sqlite, see _dataframe_to_records -> list
+        """
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            return [None if pd.isna(v) else v.isoformat(sep=' ') for v in serie]
+        if pd.api.types.is_timedelta64_dtype(serie):
+            return [None if pd.isna(v) else v.value for v in serie]
+        values = serie.to_numpy(dtype=object)
+        missing = pd.isna(values)
+        if missing.any():
+            # object columns come back as a read-only view of the frame
+            values = values.copy()
+            values[missing] = None
+        return values.tolist()
+
+    @staticmethod
+    def _to_stored_value(value, affinity):
+        """
+        converts a value bound to sqlite into the value a column of the affinity stores
+        (https://www.sqlite.org/datatype3.html): the numbers become text in a TEXT column, the well-formed numeric
+        text becomes a number in the other ones, and the whole floats are written as integers so 2 and 2.0 are the
+        same value
+        :param value: a value returned by _serie_to_values
+        :param affinity: the affinity of the column, see _get_affinity -> str
+        """
+        if isinstance(value, bool):
+            value = int(value)
+        if affinity == 'TEXT':
+            return value if value is None or isinstance(value, str) else str(value)
+        if isinstance(value, str):
+            try:
+                number = float(value)
+            except ValueError:
+                return value
+            if not math.isfinite(number):
+                return value
+            try:
+                return int(value)
+            except ValueError:
+                value = number
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    def _get_row_hashes(self, df, table_name):
+        """
+        hashes the rows of the dataframe as the table stores them: each value is converted by the affinity of the
+        declared type of its column (see _to_stored_value), so the same values hash the same whatever dtypes
+        pandas gave them, e.g. an integer column turned to float by a missing value, or read as text
+        :param df: the columns hashed -> pandas.DataFrame object
+        :param table_name: the name of the table in the database, holding the columns -> str
+        :return: the hash of each row, 0 for every row when there is no column -> numpy.ndarray of int64
+        """
+        if len(df.columns) == 0:
+            return np.zeros(len(df), dtype='int64')
+        types = self._get_table_types(table_name)
+        stored = {}
+        for col in df.columns:
+            affinity = self._get_affinity(types.get(col, ''))
+            serie = df[col]
+            if affinity != 'TEXT' and pd.api.types.is_float_dtype(serie):
+                # _to_stored_value done on the whole column
+                numbers = serie.to_numpy(dtype='float64', na_value=np.nan)
+                values = numbers.astype(object)
+                whole = np.isfinite(numbers) & (numbers % 1 == 0) & (np.abs(numbers) < 2 ** 63)
+                values[whole] = numbers[whole].astype('int64')
+                values[np.isnan(numbers)] = None
+            elif ((affinity != 'TEXT' and pd.api.types.is_integer_dtype(serie))
+                  or pd.api.types.is_datetime64_any_dtype(serie)
+                  or (affinity == 'TEXT' and pd.api.types.is_string_dtype(serie)
+                      and not isinstance(serie.dtype, pd.CategoricalDtype))):
+                # already stored as they are bound
+                values = self._serie_to_values(serie)
+            else:
+                values = [self._to_stored_value(value, affinity) for value in self._serie_to_values(serie)]
+            stored[col] = pd.Series(values, dtype=object)
+        return pd.util.hash_pandas_object(pd.DataFrame(stored), index=False).to_numpy().view('int64')
+
+    @staticmethod
+    def _shrink_dataframe(df, max_categories_ratio=0.5):
+        """
+        shrinks the dtypes of a dataframe in place without changing its values: the integer columns are downcast
+        to the smallest integer type holding them and the text columns with few distinct values (less than
+        max_categories_ratio of the rows) become categorical. The floats are kept as they are since float32
+        would change the values written
+        :param df: the dataframe to shrink -> pandas.DataFrame object
+        :param max_categories_ratio: the maximum distinct values / rows ratio of a text column made categorical
+        -> float
+        :return: the dataframe
+        """
+        for col in df.columns:
+            serie = df[col]
+            if pd.api.types.is_integer_dtype(serie) and not pd.api.types.is_extension_array_dtype(serie):
+                df[col] = pd.to_numeric(serie, downcast='integer')
+            elif ((pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie))
+                  and not isinstance(serie.dtype, pd.CategoricalDtype) and len(serie)):
+                # the text columns are StringDtype from pandas 3, object before
+                if serie.nunique() < max_categories_ratio * len(serie):
+                    df[col] = serie.astype('category')
+        return df
+
+    def _write_dataframe(self, df, table_name, schema='', chunksize=None):
+        """
+        appends the dataframe to the table. The table is created with the column types of the schema if it doesn't
+        exist yet, the columns the table doesn't have yet are added to it (see _create_table). The columns of
+        a declared schema are cast before the insert (see _cast_to_schema). The write is committed right away
+        unless it happens inside a transaction() block
+        :param df: the dataframe to write -> pandas.DataFrame object
+        :param table_name: the name of the table in the database -> str
+        :param schema: the column types, see _get_schema -> '', 'infer' or dict
+        :param chunksize: number of rows converted and sent per executemany call, all at once if None -> int
+        :return: the number of rows written
+        """
+        con = self._get_connection()
+        self._create_table(df, table_name, schema)
+        if isinstance(schema, dict):
+            self._cast_to_schema(df, schema)
+        if table_name not in INTERNAL_TABLES:
+            self._ensure_upload_indexes(table_name, df.columns)
+        columns = ', '.join('"%s"' % col for col in df.columns)
+        placeholders = ', '.join('?' for _ in df.columns)
+        query = 'INSERT INTO "%s" (%s) VALUES (%s);' % (table_name, columns, placeholders)
+        chunksize = chunksize or (LOW_MEMORY_CHUNKSIZE if self.low_memory else max(len(df), 1))
+        cur = con.cursor()
+        for start in range(0, len(df), chunksize):
+            cur.executemany(query, self._dataframe_to_records(df.iloc[start:start + chunksize]))
+        if not self._in_transaction():
+            con.commit()
+        return len(df)
+
+    # Validation
+    def _validate_dataframe(self, df, rules):
+        """
+        checks the rows of the dataframe against the rules of its columns, each rule is one vectorized mask over the
+        whole column:
+            type: the values must convert to the type (see SCHEMA_TYPE_ALIASES), the column is converted for the
+            valid rows, e.g. the dates parsed
+            not_null: true, the values can't be missing
+            min / max: the values can't be lower / greater, dates are compared as dates
+            regex: the text of the values must match the regular expression (re.search, anchor it with ^...$)
+            unique: true, a value can't be in several rows of the dataframe (of the chunk when loading chunks)
+        the missing values only fail not_null
+        :param df: the dataframe to check -> pandas.DataFrame object
+        :param rules: the rules of each column {column: {rule: value}}, e.g. {'date': {'type': 'date',
+        'not_null': True}, 'amount': {'type': 'float', 'min': 0}, 'email': {'regex': '^[^@]+@[^@]+$'}} -> dict
+        :return: the valid rows, and the failing rows as they were with an errors column listing the failed rules
+        ('date: type; amount: min') -> (pandas.DataFrame object, pandas.DataFrame object)
+        """
+        errors = np.full(len(df), '', dtype=object)
+        casts = {}
+        integers = set()
+        for column, rule in rules.items():
+            column = self._field_name_to_db_format(column)
+            if column not in df.columns:
+                raise ValueError('the column %s of the validation rules is not in the dataframe' % column)
+            serie = df[column]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                serie = serie.astype(object)
+            missing = serie.isna().to_numpy()
+            checks = []
+            if rule.get('not_null', False):
+                checks.append(('not_null', missing))
+            values = serie
+            if 'type' in rule:
+                sql_type = self._normalize_sql_type(rule['type'])
+                affinity = self._get_affinity(sql_type)
+                if 'DATE' in sql_type or 'TIME' in sql_type:
+                    values = pd.to_datetime(serie, errors='coerce', format='mixed')
+                elif affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+                    values = pd.to_numeric(serie, errors='coerce')
+                    if affinity == 'INTEGER':
+                        values = values.where(values % 1 == 0)
+                        integers.add(column)
+                elif affinity == 'TEXT':
+                    values = serie.astype(str).where(serie.notna(), None)
+                checks.append(('type', values.isna().to_numpy() & ~missing))
+                casts[column] = values
+            if 'min' in rule or 'max' in rule:
+                if pd.api.types.is_datetime64_any_dtype(values):
+                    bounds = {key: pd.Timestamp(rule[key]) for key in ('min', 'max') if key in rule}
+                else:
+                    values = pd.to_numeric(values, errors='coerce')
+                    bounds = {key: rule[key] for key in ('min', 'max') if key in rule}
+                if 'min' in bounds:
+                    checks.append(('min', (values < bounds['min']).to_numpy(dtype=bool, na_value=False)))
+                if 'max' in bounds:
+                    checks.append(('max', (values > bounds['max']).to_numpy(dtype=bool, na_value=False)))
+            if 'regex' in rule:
+                matched = serie.astype(str).str.contains(rule['regex'], regex=True).to_numpy(dtype=bool)
+                checks.append(('regex', ~matched & ~missing))
+            if rule.get('unique', False):
+                checks.append(('unique', serie.duplicated(keep=False).to_numpy() & ~missing))
+            for name, failed in checks:
+                errors[failed] = errors[failed] + '%s: %s; ' % (column, name)
+        failed = errors != ''
+        quarantine = df.take(np.flatnonzero(failed)).assign(errors=[error[:-2] for error in errors[failed]])
+        valid = df.take(np.flatnonzero(~failed)) if failed.any() else df
+        for column, values in casts.items():
+            values = values[~failed].to_numpy() if failed.any() else values.to_numpy()
+            valid[column] = pd.array(values, dtype='Int64') if column in integers else values
+        return valid, quarantine
+
+    def _write_quarantine(self, quarantine, table_name, control_id):
+        """
+        appends the rows that failed the validation to <table_name>_quarantine and sets their count in the
+        control_table row of the upload (0 when every row passed)
+        :param quarantine: the failing rows, see _validate_dataframe -> pandas.DataFrame object
+        :param table_name: the name of the table in the database -> str
+        :param control_id: the control_id of the upload -> str
+        :return: the number of rows quarantined
+        """
+        if len(quarantine):
+            self._write_dataframe(quarantine, table_name + QUARANTINE_SUFFIX)
+            print('%d lignes mises en quarantaine dans %s' % (len(quarantine), table_name + QUARANTINE_SUFFIX))
+        self._get_connection().execute(
+            'UPDATE control_table SET rows_quarantined = coalesce(rows_quarantined, 0) + ? WHERE control_id = ?;',
+            (len(quarantine), control_id))
+        return len(quarantine)
+
+    # Merge
+    @staticmethod
+    def _merge_key_index(table_name):
+        return '%s_merge_key' % table_name
+
+    def _is_merged_table(self, table_name):
+        """
+        :return: True if the table was loaded with merge_keys, it then has a unique index on them
+        """
+        return self._merge_key_index(table_name) in self._get_metadata()['indexes']
+
+    def _create_merge_key_index(self, table_name, merge_keys):
+        """
+        creates the unique index making the table a merged table, its latest view, created for an appended table,
+        is created again to show all its rows (see create_latest_view)
+        :param table_name: the name of the table in the database -> str
+        :param merge_keys: the key columns -> list
+        """
+        con = self._get_connection()
+        index_name = self._merge_key_index(table_name)
+        try:
+            con.execute('CREATE UNIQUE INDEX IF NOT EXISTS "%s" ON "%s" (%s);' % (
+                index_name, table_name, ', '.join('"%s"' % key for key in merge_keys)))
+        except sqlite3.IntegrityError:
+            raise ValueError('the table %s already holds several rows with the same %s, it can not be merged on '
+                             'them' % (table_name, ', '.join(merge_keys))) from None
+        metadata = self._get_metadata()
+        metadata['indexes'].add(index_name)
+        if table_name + '_latest' in metadata['views']:
+            con.execute('DROP VIEW IF EXISTS "%s_latest";' % table_name)
+            metadata['views'].discard(table_name + '_latest')
+            self.create_latest_view(table_name)
+
+    def _merge_dataframe(self, df, table_name, merge_keys, schema='', chunksize=None):
+        """
+        merges the dataframe into the table on its key columns instead of appending it: the rows with new keys are
+        inserted, the rows whose values changed are updated and take the control_id of the current upload, the
+        identical rows are left as they are. Rows are compared through a row_hash column holding the hash of
+        their values as the table stores them (control columns excluded, see _get_row_hashes), the upsert is one
+        INSERT ... ON CONFLICT DO UPDATE ... WHERE the hash differs. The key columns get a unique index, when the
+        dataframe holds the same key several times its last row is kept. The counts are added to the control_table
+        row of the upload. Must run inside a transaction, see insert_DataFrame_to_sqlite_table
+        :param df: the dataframe to merge -> pandas.DataFrame object
+        :param table_name: the name of the table in the database -> str
+        :param merge_keys: the key columns -> list
+        :param schema: the column types, see _get_schema -> '', 'infer' or dict
+        :param chunksize: number of rows converted and sent per executemany call, all at once if None -> int
+        :return: {'rows': int, 'inserted': int, 'updated': int, 'unchanged': int, 'duplicates': int}
+        """
+        missing = [key for key in merge_keys if key not in df.columns]
+        if missing:
+            raise ValueError('merge keys missing from the dataframe of %s: %s' % (table_name, missing))
+        rows = len(df)
+        if df.duplicated(merge_keys, keep='last').any():
+            df = df.drop_duplicates(merge_keys, keep='last')
+        hashed = [col for col in df.columns if col not in merge_keys and col not in ('control_id', 'upload')]
+        df = df.assign(row_hash=np.zeros(len(df), dtype='int64'))
+        con = self._get_connection()
+        self._create_table(df, table_name, schema)
+        if isinstance(schema, dict):
+            self._cast_to_schema(df, schema)
+        df['row_hash'] = self._get_row_hashes(df[hashed], table_name)
+        if not self._is_merged_table(table_name):
+            self._create_merge_key_index(table_name, merge_keys)
+        self._ensure_upload_indexes(table_name, df.columns)
+        columns = ', '.join('"%s"' % col for col in df.columns)
+        placeholders = ', '.join('?' for _ in df.columns)
+        updates = ', '.join('"%s" = excluded."%s"' % (col, col) for col in df.columns if col not in merge_keys)
+        query = '''INSERT INTO "%s" (%s) VALUES (%s)
+        ON CONFLICT (%s) DO UPDATE SET %s WHERE "%s".row_hash IS NOT excluded.row_hash;''' % (
+            table_name, columns, placeholders, ', '.join('"%s"' % key for key in merge_keys), updates, table_name)
+        max_rowid = con.execute('SELECT coalesce(max(rowid), 0) FROM "%s";' % table_name).fetchone()[0]
+        chunksize = chunksize or (LOW_MEMORY_CHUNKSIZE if self.low_memory else max(len(df), 1))
+        cur = con.cursor()
+        changed = 0
+        for start in range(0, len(df), chunksize):
+            cur.executemany(query, self._dataframe_to_records(df.iloc[start:start + chunksize]))
+            changed += cur.rowcount
+        inserted = con.execute('SELECT count(*) FROM "%s" WHERE rowid > ?;' % table_name, (max_rowid,)).fetchone()[0]
+        counts = {'rows': rows, 'inserted': inserted, 'updated': changed - inserted,
+                  'unchanged': len(df) - changed, 'duplicates': rows - len(df)}
+        con.execute('''UPDATE control_table SET rows_inserted = coalesce(rows_inserted, 0) + ?,
+        rows_updated = coalesce(rows_updated, 0) + ?, rows_unchanged = coalesce(rows_unchanged, 0) + ?
+        WHERE control_id = ?;''', (counts['inserted'], counts['updated'], counts['unchanged'],
+                                   df['control_id'].iloc[0] if len(df) else None))
+        return counts
+
+    # Schema
+    @staticmethod
+    def _normalize_sql_type(sql_type):
+        """
+        :param sql_type: a type of a schema, e.g. 'int', 'TEXT', 'date', 'VARCHAR(20)' -> str
+        :return: the sql type written in the CREATE TABLE, e.g. 'INTEGER', 'TEXT', 'TIMESTAMP', 'VARCHAR(20)'
+        """
+        return SCHEMA_TYPE_ALIASES.get(sql_type.lower(), sql_type.upper())
+
+    @staticmethod
+    def _get_affinity(sql_type):
+        """
+        returns the affinity sqlite gives to a declared column type (https://www.sqlite.org/datatype3.html)
+        :param sql_type: the declared type of the column -> str
+        :return: 'INTEGER', 'TEXT', 'BLOB', 'REAL' or 'NUMERIC'
+        """
+        sql_type = sql_type.upper()
+        if 'INT' in sql_type:
+            return 'INTEGER'
+        if 'CHAR' in sql_type or 'CLOB' in sql_type or 'TEXT' in sql_type:
+            return 'TEXT'
+        if 'BLOB' in sql_type or sql_type == '':
+            return 'BLOB'
+        if 'REAL' in sql_type or 'FLOA' in sql_type or 'DOUB' in sql_type:
+            return 'REAL'
+        return 'NUMERIC'
+
+    @staticmethod
+    def _infer_sql_type(serie, infer=False):
+        """
+        returns the sql type of a column from its dtype, like pandas.to_sql does. With infer=True the values of a
+        sample are looked at too: text columns holding only numbers become INTEGER or REAL (not the ones with
+        leading zeros like zip codes, they stay TEXT) and float columns holding only whole numbers (integers with
+        missing values) become INTEGER
+        :param serie: the column -> pandas.Series object
+        :param infer: look at the values and not only at the dtype -> bool
+        :return: str
+        """
+        if pd.api.types.is_bool_dtype(serie) or pd.api.types.is_integer_dtype(serie):
+            return 'INTEGER'
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            return 'TIMESTAMP'
+        if pd.api.types.is_timedelta64_dtype(serie):
+            return 'INTEGER'
+        sample = serie.dropna().head(SCHEMA_SAMPLE_ROWS) if infer else None
+        if pd.api.types.is_float_dtype(serie):
+            if infer and len(sample) and (sample % 1 == 0).all():
+                return 'INTEGER'
+            return 'REAL'
+        if infer and len(sample):
+            numbers = pd.to_numeric(sample, errors='coerce')
+            if numbers.notna().all() and not sample.astype(str).str.match(r'\s*[+-]?0\d').any():
+                return 'INTEGER' if (numbers % 1 == 0).all() else 'REAL'
+        return 'TEXT'
+
+    def _get_schema(self, df, schema=''):
+        """
+        returns the sql type of each column of the dataframe
+        :param df: the dataframe -> pandas.DataFrame object
+        :param schema: '' to type the columns from their dtypes like pandas.to_sql, 'infer' to infer them from
+        a sample of their values too (see _infer_sql_type), or a dict of declared types {column: type} (see
+        SCHEMA_TYPE_ALIASES), the undeclared columns are then inferred -> '', 'infer' or dict
+        :return: {column: sql type}
+        """
+        declared = schema if isinstance(schema, dict) else {}
+        infer = schema != ''
+        return {col: self._normalize_sql_type(declared[col]) if col in declared
+                else self._infer_sql_type(df[col], infer) for col in df.columns}
+
+    def _get_table_types(self, table_name):
+        """
+        :param table_name: the name of the table in the database -> str
+        :return: the declared types of the columns of the table {column: type}, from the metadata cache
+        """
+        columns = self._get_metadata()['columns']
+        if table_name not in columns:
+            columns[table_name] = {row[1]: row[2] for row in self._get_connection().execute(
+                'PRAGMA table_info("%s");' % table_name)}
+        return columns[table_name]
+
+    def _create_table(self, df, table_name, schema=''):
+        """
+        creates the table with the column types of the schema (see _get_schema) if it doesn't exist yet. When it
+        exists the columns of the dataframe it doesn't have yet are
+        added to it with ALTER TABLE ADD COLUMN, the rows already there get NULL in them
+        :param df: the dataframe to write in the table -> pandas.DataFrame object
+        :param table_name: the name of the table in the database -> str
+        :param schema: the column types, see _get_schema -> '', 'infer' or dict
+        """
+        con = self._get_connection()
+        metadata = self._get_metadata()
+        if not self._check_if_table_exists(table_name):
+            types = self._get_schema(df, schema)
+            con.execute('CREATE TABLE "%s" (\n%s\n);' % (
+                table_name, ',\n'.join('  "%s" %s' % (col, sql_type) for col, sql_type in types.items())))
+            metadata['tables'].add(table_name)
+            metadata['columns'][table_name] = types
+            return
+        table_types = self._get_table_types(table_name)
+        new_columns = [col for col in df.columns if col not in table_types]
+        if new_columns:
+            for col, sql_type in self._get_schema(df[new_columns], schema).items():
+                con.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s;' % (table_name, col, sql_type))
+                table_types[col] = sql_type
+            print('nouvelles colonnes ajoutees a la table %s: %s' % (table_name, ', '.join(new_columns)))
+
+    def _cast_to_schema(self, df, schema):
+        """
+        casts the columns of a declared schema in place to the affinity of their type, so the values stored don't
+        depend on what pandas inferred from the file: INTEGER and REAL columns through pandas.to_numeric, the
+        date and time types through pandas.to_datetime, TEXT columns to str. The values that can't be
+        converted become NULL, their count is printed
+        :param df: the dataframe to cast -> pandas.DataFrame object
+        :param schema: the declared types {column: type} -> dict
+        """
+        for col, sql_type in schema.items():
+            if col not in df.columns:
+                continue
+            sql_type = self._normalize_sql_type(sql_type)
+            affinity = self._get_affinity(sql_type)
+            serie = df[col]
+            if 'DATE' in sql_type or 'TIME' in sql_type:
+                if pd.api.types.is_datetime64_any_dtype(serie):
+                    continue
+                cast = pd.to_datetime(serie, errors='coerce', format='mixed')
+            elif affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+                if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+                    continue
+                cast = pd.to_numeric(serie, errors='coerce')
+                if affinity == 'INTEGER' and (cast.dropna() % 1 == 0).all():
+                    cast = cast.astype('Int64')
+            elif affinity == 'TEXT':
+                if pd.api.types.is_string_dtype(serie) and pd.api.types.infer_dtype(serie, skipna=True) == 'string':
+                    continue
+                cast = serie.astype(str).where(serie.notna(), None)
+            else:
+                continue
+            lost = int(cast.isna().sum() - serie.isna().sum())
+            if lost > 0:
+                print('%d valeurs de la colonne %s ne sont pas du type %s, remplacees par NULL' % (lost, col, sql_type))
+            df[col] = cast
+
+    # Upload storage
+    def _ensure_upload_indexes(self, table_name, columns):
+        """
+        creates the index on the control_id column of a data table, and on its upload column if it has one, and
+        its latest view (see create_latest_view), the tables created by a previous version of the pipeline get them
+        on their next insert. The indexes and views already created are known from the metadata cache so this
+        costs nothing on the next inserts
+        :param table_name: the name of the table in the database -> str
+        :param columns: the columns of the table -> list
+        """
+        metadata = self._get_metadata()
+        indexes = metadata['indexes']
+        for column in ('control_id', 'upload'):
+            index_name = '%s_%s_idx' % (table_name, column)
+            if column in columns and index_name not in indexes:
+                self._get_connection().execute(
+                    'CREATE INDEX IF NOT EXISTS "%s" ON "%s" ("%s");' % (index_name, table_name, column))
+                indexes.add(index_name)
+        if ('control_id' in columns and table_name + '_latest' not in metadata['views']
+                and not table_name.endswith(QUARANTINE_SUFFIX)):
+            self.create_latest_view(table_name)
+
+    def create_latest_view(self, table_name):
+        """
+        creates the view <table_name>_latest showing only the latest upload of the table, following the upload it
+        references when it was aligned by reference (see _update_upload_ids), done automatically by the inserts
+        (see _ensure_upload_indexes). The rows of a merged table (see _merge_dataframe) are its current state, its
+        view shows all of them
+        :param table_name: the name of the table in the database -> str
+        """
+        if self._is_merged_table(table_name):
+            self._get_connection().execute(
+                'CREATE VIEW IF NOT EXISTS "%s_latest" AS SELECT * FROM "%s";' % (table_name, table_name))
+        else:
+            self._get_connection().execute(
+                '''CREATE VIEW IF NOT EXISTS "%s_latest" AS SELECT * FROM "%s" WHERE control_id = (
+                SELECT coalesce(reference_control_id, control_id) FROM control_table WHERE table_name = '%s'
+                ORDER BY upload DESC LIMIT 1);''' % (table_name, table_name, table_name.replace("'", "''")))
+        self._get_metadata()['views'].add(table_name + '_latest')
+
+    def apply_retention(self, table_name, keep_last='', older_than_days='', vacuum=''):
+        """
+        deletes the old uploads of a table: their rows, their control_table, file_manifest and quarantine rows. The
+        latest upload and the uploads still referenced by a kept upload are never deleted. The rows of a merged table
+        (see _merge_dataframe) are its current state, only the control_table and file_manifest rows of its
+        old uploads are deleted
+        :param table_name: the table, or list of tables, to clean -> str or list
+        :param keep_last: keeps only the keep_last latest uploads -> int
+        :param older_than_days: deletes the uploads inserted more than older_than_days days ago -> int or float
+        :param vacuum: '' to leave the freed pages in the database file, 'incremental' to give them back with
+        PRAGMA incremental_vacuum (the database is switched to auto_vacuum=INCREMENTAL once, with a full VACUUM),
+        'full' to rebuild the whole file with VACUUM -> str
+        :return: the list of the deleted control_ids
+        """
+        table_names = table_name if isinstance(table_name, list) else [table_name]
+        con = self._get_connection()
+        deleted = []
+        with self.transaction():
+            for table_name in table_names:
+                uploads = con.execute(
+                    '''SELECT control_id, upload, insert_date, reference_control_id FROM control_table
+                    WHERE table_name = ? ORDER BY upload DESC;''', (table_name,)).fetchall()
+                to_delete = set()
+                if keep_last != '':
+                    to_delete.update(row[0] for row in uploads[keep_last:])
+                if older_than_days != '':
+                    limit = (datetime.datetime.now() - datetime.timedelta(days=older_than_days)).isoformat(sep=' ')
+                    to_delete.update(row[0] for row in uploads if str(row[2]) < limit)
+                if uploads:
+                    to_delete.discard(uploads[0][0])
+                kept_references = {row[3] for row in uploads if row[0] not in to_delete and row[3] is not None}
+                control_ids = [(control_id,) for control_id in to_delete]
+                data_control_ids = [(control_id,) for control_id in to_delete if control_id not in kept_references]
+                if self._check_if_table_exists(table_name) and not self._is_merged_table(table_name):
+                    con.executemany('DELETE FROM "%s" WHERE control_id = ?;' % table_name, data_control_ids)
+                con.executemany('DELETE FROM control_table WHERE control_id = ?;', control_ids)
+                if self._check_if_table_exists('file_manifest'):
+                    con.executemany('DELETE FROM file_manifest WHERE control_id = ?;', control_ids)
+                if self._check_if_table_exists(table_name + QUARANTINE_SUFFIX):
+                    con.executemany('DELETE FROM "%s" WHERE control_id = ?;' % (table_name + QUARANTINE_SUFFIX),
+                                    control_ids)
+                deleted.extend(sorted(to_delete))
+        self.clear_query_cache(table_names + ['control_table'])
+        if vacuum == 'full':
+            con.execute('VACUUM;')
+        elif vacuum == 'incremental':
+            if con.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+                con.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+                con.execute('VACUUM;')
+            con.execute('PRAGMA incremental_vacuum;')
+        return deleted
+
+    # Upload diff
+    def _get_upload_control_id(self, table_name, upload):
+        """
+        :param upload: an upload number of the table or a control_id -> int or str
+        :return: the control_id of the upload and its upload number
+        """
+        column = 'control_id' if isinstance(upload, str) else 'upload'
+        row = self._get_connection().execute(
+            'SELECT control_id, upload FROM control_table WHERE table_name = ? AND %s = ?;' % column,
+            (table_name, upload)).fetchone()
+        if row is None:
+            raise ValueError('the table %s has no upload %s' % (table_name, upload))
+        return row
+
+    def _ensure_diff_index(self, table_name, key_columns):
+        """
+        creates the index on (control_id, key columns) the diff of two uploads looks the rows up with, once for
+        each set of key columns of the table
+        """
+        index_name = '%s_diff_%s_idx' % (table_name, '_'.join(key_columns))
+        indexes = self._get_metadata()['indexes']
+        if index_name not in indexes:
+            con = self._get_connection()
+            con.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (control_id, %s);'
+                        % (index_name, table_name, ', '.join('"%s"' % key for key in key_columns)))
+            if not self._in_transaction():
+                con.commit()
+            indexes.add(index_name)
+
+    def diff_uploads(self, table_name, key_columns, old='', new='', chunksize='', output='pandas', summary=False):
+        """
+        compares two uploads of a table on key columns, entirely in sqlite: the rows of new whose key isn't in old
+        are 'added', the rows of old whose key isn't in new are 'removed' and the rows of new whose key is in old
+        with other values are 'changed'. The rows are looked up through an index on (control_id, key columns),
+        created by the first diff of the table on these keys
+            pipeline.diff_uploads('sales', ['sale_id'], chunksize=100000)   # the latest upload against the previous one
+        :param table_name: the name of the table in the database -> str
+        :param key_columns: the columns identifying a row, unique within an upload -> list
+        :param old: the upload compared, an upload number or a control_id, the upload before new if '' -> int or str
+        :param new: the upload compared to old, an upload number or a control_id, the latest upload if ''
+        -> int or str
+        :param chunksize: streams the result by chunks of chunksize rows, see fetch_dataframe_using_query -> int
+        :param output: 'pandas', 'arrow' or 'rows', see fetch_dataframe_using_query -> str
+        :param summary: if True only the number of rows of each change is returned -> bool
+        :return: a 'change' column followed by the columns of the table, with the values of new for the added and
+        changed rows and the ones of old for the removed rows. {'added': int, 'removed': int, 'changed': int}
+        if summary
+        """
+        if self._is_merged_table(table_name):
+            raise ValueError('the previous uploads of the merged table %s are not kept, they can not be compared'
+                             % table_name)
+        if new == '':
+            new = self._get_latest_upload(table_name)
+            if new is None:
+                raise ValueError('the table %s has no upload' % table_name)
+        new_control_id, new_upload = self._get_upload_control_id(table_name, new)
+        if old == '':
+            old = self._get_connection().execute(
+                'SELECT max(upload) FROM control_table WHERE table_name = ? AND upload < ?;',
+                (table_name, new_upload)).fetchone()[0]
+            if old is None:
+                raise ValueError('the upload %s of the table %s has no previous upload' % (new_upload, table_name))
+        old_control_id = self._get_upload_control_id(table_name, old)[0]
+        key_columns = [self._field_name_to_db_format(key) for key in key_columns]
+        columns = [column for column in self._get_table_columns(table_name)
+                   if column not in ('control_id', 'upload', 'row_hash')]
+        missing = [key for key in key_columns if key not in columns]
+        if missing:
+            raise ValueError('the table %s has no column %s' % (table_name, ', '.join(missing)))
+        self._ensure_diff_index(table_name, key_columns)
+        old_id, new_id = (self._get_data_control_id(control_id).replace("'", "''")
+                          for control_id in (old_control_id, new_control_id))
+        same_key = ' AND '.join('o."%s" IS n."%s"' % (key, key) for key in key_columns)
+        changed = ' OR '.join('o."%s" IS NOT n."%s"' % (column, column)
+                              for column in columns if column not in key_columns) or '0'
+        query = '''SELECT 'added' AS change, {new_columns} FROM "{table}" n WHERE n.control_id = '{new}'
+        AND NOT EXISTS (SELECT 1 FROM "{table}" o WHERE o.control_id = '{old}' AND {same_key})
+        UNION ALL
+        SELECT 'removed', {old_columns} FROM "{table}" o WHERE o.control_id = '{old}'
+        AND NOT EXISTS (SELECT 1 FROM "{table}" n WHERE n.control_id = '{new}' AND {same_key})
+        UNION ALL
+        SELECT 'changed', {new_columns} FROM "{table}" n JOIN "{table}" o ON o.control_id = '{old}' AND {same_key}
+        WHERE n.control_id = '{new}' AND ({changed})'''.format(
+            table=table_name, old=old_id, new=new_id, same_key=same_key, changed=changed,
+            new_columns=', '.join('n."%s"' % column for column in columns),
+            old_columns=', '.join('o."%s"' % column for column in columns))
+        if summary:
+            counts = dict(self._get_connection().execute(
+                'SELECT change, count(*) FROM (%s) GROUP BY change;' % query).fetchall())
+            return {change: counts.get(change, 0) for change in ('added', 'removed', 'changed')}
+        return self.fetch_dataframe_using_query(query, chunksize=chunksize, output=output)
+
+    # Snapshots
+    @staticmethod
+    def _read_snapshot(path):
+        """
+        :param path: the path of a snapshot written by export_snapshot -> str
+        :return: the pyarrow ParquetFile and the snapshot metadata {'table_name', 'types', 'control_table',
+        'merge_keys'}
+        """
+        Pipeline._require_pyarrow()
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.schema_arrow.metadata or {}
+        if SNAPSHOT_METADATA_KEY not in metadata:
+            raise ValueError('%s is not a snapshot of the pipeline, see export_snapshot' % path)
+        return parquet_file, json.loads(metadata[SNAPSHOT_METADATA_KEY])
+
+    def export_snapshot(self, path, table_name, control_id='', chunksize=100000):
+        """
+        exports a table, or a single upload of it, to a parquet file chunk by chunk along with its control_table
+        rows and the declared types of its columns, stored in the metadata of the file, so import_snapshot can
+        restore it without reading the source files again. The values are written as sqlite holds them (dates
+        as text), the rows of an upload aligned by reference are exported under its own control_id
+        :param path: the path of the parquet file to write -> str
+        :param table_name: the name of the table in the database -> str
+        :param control_id: the upload to export, the whole table if '' -> str
+        :param chunksize: the number of rows read and written at a time -> int
+        :return: the number of rows written
+        """
+        self._require_pyarrow()
+        con = self._get_connection()
+        columns = self._get_table_columns(table_name)
+        if control_id == '':
+            where = '1'
+            select = ', '.join('"%s"' % col for col in columns)
+            control_rows = con.execute('SELECT * FROM control_table WHERE table_name = ? ORDER BY upload;',
+                                       (table_name,))
+        else:
+            if self._is_merged_table(table_name):
+                raise ValueError('the rows of the merged table %s are its current state, only the whole table can '
+                                 'be exported' % table_name)
+            where = "control_id = '%s'" % self._get_data_control_id(control_id).replace("'", "''")
+            select = ', '.join("'%s' AS control_id" % control_id.replace("'", "''") if col == 'control_id'
+                               else '"%s"' % col for col in columns)
+            control_rows = con.execute('SELECT * FROM control_table WHERE control_id = ?;', (control_id,))
+        control_table = [dict(zip([column[0] for column in control_rows.description], row)) for row in control_rows]
+        if control_id != '' and control_table:
+            control_table[0]['reference_control_id'] = None
+        merge_keys = []
+        if self._is_merged_table(table_name):
+            merge_keys = [row[2] for row in con.execute('PRAGMA index_info("%s");' % self._merge_key_index(table_name))]
+        query = 'SELECT %s FROM "%s" WHERE %s' % (select, table_name, where)
+        metadata = {SNAPSHOT_METADATA_KEY: json.dumps({
+            'table_name': table_name, 'types': self._get_table_types(table_name), 'control_table': control_table,
+            'merge_keys': merge_keys}, default=str)}
+        with self._stage('export', table_name) as event:
+            event['rows'] = self._write_parquet(path, query, chunksize, self._get_table_types(table_name), metadata)
+        return event['rows']
+
+    def import_snapshot(self, path, table_name='', as_new_upload=False, batch_size=100000):
+        """
+        restores a snapshot written by export_snapshot: its control_table rows are inserted, the table is created
+        with the declared types of the snapshot (or gets the columns it misses) and the rows are inserted batch by
+        batch straight from the columns of the parquet file, without formatting the column names nor inferring
+        their types, in one transaction
+        :param path: the path of the snapshot -> str
+        :param table_name: the table to restore the snapshot in, the one it was exported from if '' -> str
+        :param as_new_upload: imports the snapshot of a single upload as a new upload of the table instead of
+        restoring its control_id, for a database already holding that upload -> bool
+        :param batch_size: the number of rows read and inserted at a time -> int
+        :return: the number of rows inserted
+        """
+        parquet_file, snapshot = self._read_snapshot(path)
+        table_name = table_name or snapshot['table_name']
+        control_table = snapshot['control_table']
+        if as_new_upload and len(control_table) != 1:
+            raise ValueError('only the snapshot of a single upload can be imported as a new upload, %s holds %d'
+                             % (path, len(control_table)))
+        con = self._get_connection()
+        names = parquet_file.schema_arrow.names
+        query = 'INSERT INTO "%s" (%s) VALUES (%s);' % (
+            table_name, ', '.join('"%s"' % name for name in names), ', '.join('?' for _ in names))
+        rows = 0
+        with self._stage('write', table_name) as event, self.transaction():
+            if as_new_upload:
+                self._create_control_table(path, table_name)
+                upload = self._get_latest_upload(table_name)
+                control_id = table_name + str(upload)
+            else:
+                metadata = self._get_metadata()
+                if 'control_table' not in metadata['tables']:
+                    con.execute(CONTROL_TABLE_DDL)
+                    con.execute(CONTROL_TABLE_INDEX_DDL)
+                    metadata['tables'].add('control_table')
+                control_ids = [row['control_id'] for row in control_table]
+                existing = [row[0] for row in con.execute('SELECT control_id FROM control_table WHERE control_id IN '
+                                                          '(%s);' % ', '.join('?' for _ in control_ids), control_ids)]
+                if existing:
+                    raise ValueError('the uploads %s are already in the database, see as_new_upload'
+                                     % ', '.join(existing))
+                control_df = pd.DataFrame(control_table).assign(table_name=table_name)
+                self._write_dataframe(control_df, 'control_table')
+                metadata['latest_uploads'][table_name] = max(self._get_latest_upload(table_name) or 0,
+                                                             int(control_df['upload'].max()))
+            types = snapshot['types']
+            self._create_table(pd.DataFrame(columns=list(types)), table_name, types)
+            self._ensure_upload_indexes(table_name, list(types))
+            cur = con.cursor()
+            for batch in parquet_file.iter_batches(batch_size):
+                columns = [column.to_pylist() for column in batch.columns]
+                if as_new_upload:
+                    for name, value in (('control_id', control_id), ('upload', upload)):
+                        if name in names:
+                            columns[names.index(name)] = [value] * batch.num_rows
+                cur.executemany(query, zip(*columns))
+                rows += batch.num_rows
+            if snapshot['merge_keys'] and not self._is_merged_table(table_name):
+                self._create_merge_key_index(table_name, snapshot['merge_keys'])
+            event['rows'] = rows
+        self.clear_query_cache([table_name, 'control_table'])
+        return rows
 
     # Formatting functions, more or less helper functions
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def _field_name_to_db_format(column_name):
         """
         transforms the string passed into a sequence of alphanumeric characters in lower case
@@ -28,18 +1457,49 @@ class Pipeline:
             Returns:
                 if input: '//:ZErt88//:fdgg__Xkf'
                 output: 'zert88_fdgg_xkf'
+        The results are memoized, the same headers come back in every file of a folder or chunk of a csv
+        """
+        l = FIELD_NAME_SPLIT_PATTERN.split(unidecode.unidecode(column_name.lower()))
+        return '_'.join(element for element in l if element != '')
+
+    @staticmethod
+    def _format_column_names(columns, collision_policy='suffix'):
+        """
+        formats every column name with _field_name_to_db_format and handles the names that collide once formatted
+        :param columns: the column names to format -> list
+        :param collision_policy: 'suffix' adds _2, _3, ... to the next columns having the same formatted name,
+        'error' raises a ValueError naming the original headers -> str
+        :return:
+            if input: ['Date', 'DATE', 'Prix (HT)']
+            output: ['date', 'date_2', 'prix_ht']
         """
-        pattern = '[_\W]'
-        l = re.split(pattern, unidecode.unidecode(column_name.lower()))
-        string_to_return_list = []
-        for element in l:
-            if element != '':
-                string_to_return_list.append(element)
-        string_to_return = '_'.join(string_to_return_list)
-        return string_to_return
+        formatted = [Pipeline._field_name_to_db_format(column) for column in columns]
+        if len(set(formatted)) == len(formatted):
+            return formatted
+        if collision_policy not in ('suffix', 'error'):
+            raise ValueError("unknown column collision policy: %s, use 'suffix' or 'error'" % collision_policy)
+        if collision_policy == 'error':
+            sources = {}
+            for column, name in zip(columns, formatted):
+                sources.setdefault(name, []).append(column)
+            collisions = {name: headers for name, headers in sources.items() if len(headers) > 1}
+            raise ValueError('columns colliding once formatted: %s' % collisions)
+        taken = set(formatted)
+        seen = set()
+        result = []
+        for name in formatted:
+            if name in seen:
+                i = 2
+                while '%s_%d' % (name, i) in taken:
+                    i += 1
+                name = '%s_%d' % (name, i)
+                taken.add(name)
+            seen.add(name)
+            result.append(name)
+        return result
 
     def _field_split(self, source_file, column_name_list, df, splitters_list, table_split_name, column_split_rename='',
-                     id_column=''):
+                     id_column='', new_upload=True, regex=False, strip=True, drop_empty=True):
         """
         Splits the column of a dataframe such as: row_label:(a, b, c)
         into a new dataframe made of a column looking like :    row_label:a
@@ -55,6 +1515,13 @@ class Pipeline:
         more self-explanatory joins between two tables -> list
         :param id_column: adds a column to refer to of the dataframe that's being split,
         necessary for the joins ! -> str
+        :param new_upload: False when the df is a chunk appended to the current upload of the split table -> bool
+        :param regex: if True the splitters are regular expressions, else they are literal strings of any length
+        -> bool
+        :param strip: removes the whitespaces around each value once split -> bool
+        :param drop_empty: drops the empty values once split (and stripped), e.g. the trailing one of 'a, b,' -> bool
+        All the split columns are split in one pass and written with one insert under one control_id, when several
+        columns are split in the same table each row only fills the column it comes from
         :return:
         Given the following Dataframe:
                              _____________________________________
@@ -77,21 +1544,38 @@ class Pipeline:
                             |row_a             |         c        |
                             |__________________|__________________|
         """
-        con = sqlite3.connect(self.db_path)
+        if isinstance(splitters_list, str):
+            splitters_list = [splitters_list] * len(column_name_list)
+        if id_column == '':
+            id_column = [''] * len(column_name_list)
+        if column_split_rename == '':
+            column_split_rename = column_name_list
+        frames = []
         for col_name, splitter, col_id, split_rename in zip(column_name_list, splitters_list, id_column,
                                                             column_split_rename):
-            df_2 = df[[col_name]].copy()
-            self._insert_control_columns_to_df(df_2, table_split_name)
+            values = pd.Series(df[col_name].to_numpy(), dtype='string')
+            values = values.str.split(str(splitter), regex=regex).explode()
+            if strip:
+                values = values.str.strip()
+            if drop_empty:
+                values = values[values.notna() & (values != '')]
+            positions = values.index.to_numpy()
             if col_id == '':
-                df_2.insert(1, "Id", range(1, len(df_2) + 1))
+                frame = pd.DataFrame({'Id': positions + 1})
             else:
-                df_2.insert(1, col_id, df[col_id])
-            df_2[col_name] = df_2[col_name].str.split(str(splitter))
-            df_2 = df_2.explode(col_name).reset_index(drop=True)
+                frame = pd.DataFrame({col_id: df[col_id].to_numpy()[positions]})
+            if self.low_memory:
+                frame[split_rename] = pd.Categorical(values.to_numpy(dtype=object))
+            else:
+                frame[split_rename] = values.to_numpy(dtype=object)
+            frames.append(frame)
+        if not frames:
+            return
+        df_2 = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        if new_upload:
             self._create_control_table(source_file, table_split_name)
-            if column_split_rename != '':
-                df_2.rename(columns={col_name: split_rename}, inplace=True)
-                df_2.to_sql(table_split_name, con, index=False, if_exists='append')
+        self._insert_control_columns_to_df(df_2, table_split_name)
+        self._write_dataframe(df_2, table_split_name)
 
     def _insert_control_columns_to_df(self, df, table_name):
         """
@@ -124,11 +1608,14 @@ class Pipeline:
 
 
         """
-        if self._check_if_table_exists(table_name):
-            max_upload = self._get_latest_upload(table_name)
-            df.insert(0, "control_id", table_name + str(max_upload))
+        max_upload = self._get_latest_upload(table_name) or 1
+        if self.low_memory:
+            df.insert(0, "control_id", pd.Categorical.from_codes(
+                np.zeros(len(df), dtype='int8'), [table_name + str(max_upload)]))
         else:
-            df.insert(0, "control_id", table_name + '1')
+            df.insert(0, "control_id", table_name + str(max_upload))
+        if self.upload_column:
+            df.insert(1, "upload", max_upload)
 
     def _create_control_table(self, source_file, table_name):
         """
@@ -151,31 +1638,40 @@ class Pipeline:
                             |    tableB1 |excel B          |         1        |      02/03      | A789004   |
                             |____________|_________________|__________________|_________________|___________|
         """
+        metadata = self._get_metadata()
+        if 'control_table' not in metadata['tables']:
+            con = self._get_connection()
+            con.execute(CONTROL_TABLE_DDL)
+            con.execute(CONTROL_TABLE_INDEX_DDL)
+            metadata['tables'].add('control_table')
+        max_upload = (self._get_latest_upload(table_name) or 0) + 1
         df_2 = pd.DataFrame()
-        con = sqlite3.connect(self.db_path)
-        if self._check_if_table_exists(table_name):
-            max_upload = self._get_latest_upload(table_name) + 1
-            df_2["control_id"] = [table_name + str(max_upload)]
-            df_2["source_file"] = [source_file]
-            df_2["upload"] = [max_upload]
-            df_2["insert_date"] = [datetime.datetime.now()]
-            df_2["user_id"] = [os.getlogin()]
-        else:
-            df_2["control_id"] = [table_name + '1']
-            df_2["source_file"] = [source_file]
-            df_2["upload"] = [1]
-            df_2["insert_date"] = [datetime.datetime.now()]
-            df_2["user_id"] = [os.getlogin()]
-        df_2.to_sql('control_table', con, dtype={'control_id': 'PRIMARY KEY'}, index=False, if_exists='append')
-        con.close()
+        df_2["control_id"] = [table_name + str(max_upload)]
+        df_2["source_file"] = [source_file]
+        df_2["upload"] = [max_upload]
+        df_2["insert_date"] = [datetime.datetime.now()]
+        df_2["user_id"] = [self._get_user_id()]
+        df_2["table_name"] = [table_name]
+        self._write_dataframe(df_2, 'control_table')
+        metadata['latest_uploads'][table_name] = max_upload
+
+    @staticmethod
+    def _get_user_id():
+        """
+        returns the login of the user running the pipeline, falls back on the environment when there is no
+        controlling terminal (cron, services, ...) where os.getlogin() raises
+        """
+        try:
+            return os.getlogin()
+        except OSError:
+            return getpass.getuser()
 
     def _get_control_id(self, table_name):
         """
         get the control_id of the table name passed
         :param table_name -> str
         """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
+        cur = self._get_connection().cursor()
         cur.execute("SELECT control_id from " + table_name)
         return cur.fetchone()[0]
 
@@ -185,35 +1681,19 @@ class Pipeline:
         :param table_name: the name of the table in the database -> str
         :return: 
             if the last upload of the table 'table A' is 8 then returns 8.
+            None if the table has no upload yet
         """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute("SELECT max(upload) FROM control_table WHERE control_id LIKE '" + table_name + "%'")
-        max_upload = cur.fetchone()[0]
-        return max_upload
+        return self._get_metadata()['latest_uploads'].get(table_name)
 
     def _check_if_table_exists(self, table_name):
         """
         checks if the table with the nam passed exists in the database
         :param table_name: the name of the table in the database -> str
         :return: 
-            if exists, returns 1
-            else returns 0
+            if exists, returns True
+            else returns False
         """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute('CREATE TABLE temp.temporary_table(name);')
-        cur.execute(
-            '''INSERT INTO temp.temporary_table(name) SELECT count(name)
-            FROM sqlite_master WHERE type='table'
-            AND name='%s';''' % table_name)
-        cur.execute('SELECT * FROM temporary_table;')
-        val = cur.fetchone()[0]
-        con.close()
-        if val == 1:
-            return True
-        else:
-            return False
+        return table_name in self._get_metadata()['tables']
 
     def _get_max_of_upload_ids(self, l):
         """
@@ -242,66 +1722,188 @@ class Pipeline:
             order_dict = {item: self._get_latest_upload(item) for item in l}
             return order_dict
 
-    def _update_upload_ids(self, table_name_list):
+    def _get_data_control_id(self, control_id):
+        """
+        returns the control_id under which the rows of an upload are stored: the upload itself, or the upload it
+        references when it was aligned by reference (see _update_upload_ids)
+        :param control_id: the control_id of the upload -> str
+        :return: str
+        """
+        row = self._get_connection().execute(
+            'SELECT reference_control_id FROM control_table WHERE control_id = ?;', (control_id,)).fetchone()
+        if row is None or row[0] is None:
+            return control_id
+        return row[0]
+
+    def _get_table_columns(self, table_name):
+        """
+        :param table_name: the name of the table in the database -> str
+        :return: the list of the column names of the table
+        """
+        return list(self._get_table_types(table_name))
+
+    def _update_upload_ids(self, table_name_list, by_reference=False):
         """
         When inserting a group of tables via pipeline, you might want to even their upload_ids in order to join/ insert
         them with more ease when needed, this is what the method does
         :param table_name_list: a list of the table_name you want to insert together
+        :param by_reference: if True the latest rows aren't copied, the new uploads only reference the control_id
+        holding them in the reference_control_id column of the control_table. The merged tables (see
+        _merge_dataframe) are always aligned by reference, their unique key can't hold a copy of their rows -> bool
         :return:
         let's say you have the following upload_ids for a given list of table:
             upload_ids_dict = {table_a:1, table_b:1, table_c:3, table_d:6}
         the upload_ids will be updated to:
             upload_ids_dict = {table_a:7, table_b:7, table_c:7, table_d:7}
         all the tables are then inserted and their upload ids will be 7.
+        The copy is one INSERT ... SELECT per table and the control_table rows are written in one batch, everything
+        in one transaction
 
         """
         if isinstance(table_name_list, list):
             maximum = self._get_max_of_upload_ids(table_name_list)
-            print(maximum)
+            new_upload = maximum + 1
+            con = self._get_connection()
+            insert_date = datetime.datetime.now().isoformat(sep=' ')
+            user_id = self._get_user_id()
+            with self.transaction():
+                control_rows = []
+                for table_name in table_name_list:
+                    table_latest_upload = table_name + str(self._get_latest_upload(table_name))
+                    new_table_latest = table_name + str(new_upload)
+                    data_control_id = self._get_data_control_id(table_latest_upload)
+                    source_file = con.execute('SELECT source_file FROM control_table WHERE control_id = ?;',
+                                              (table_latest_upload,)).fetchone()[0]
+                    if by_reference or self._is_merged_table(table_name):
+                        control_rows.append((new_table_latest, source_file, new_upload, insert_date, user_id,
+                                             table_name, data_control_id))
+                    else:
+                        columns = self._get_table_columns(table_name)
+                        # the control columns of the copied rows are the ones of the new upload
+                        new_values = {'control_id': new_table_latest, 'upload': new_upload}
+                        selected = ', '.join('?' if col in new_values else '"%s"' % col for col in columns)
+                        con.execute(
+                            '''INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE control_id = ?;''' % (
+                                table_name, ', '.join('"%s"' % col for col in columns), selected, table_name),
+                            [new_values[col] for col in columns if col in new_values] + [data_control_id])
+                        control_rows.append((new_table_latest, source_file, new_upload, insert_date, user_id,
+                                             table_name, None))
+                con.executemany(
+                    '''INSERT INTO control_table (control_id, source_file, upload, insert_date, user_id, table_name,
+                    reference_control_id) VALUES (?, ?, ?, ?, ?, ?, ?);''', control_rows)
+            latest_uploads = self._get_metadata()['latest_uploads']
             for table_name in table_name_list:
-                con = sqlite3.connect(self.db_path)
-                latest_upload = self._get_latest_upload(table_name)
-                print(latest_upload)
-                print(table_name)
-                table_latest_upload = table_name + str(latest_upload)
-                new_table_latest = table_name + str(maximum + 1)
-                print(new_table_latest)
-                cur = con.cursor()
-                cur.execute(
-                    '''CREATE TABLE temp.tabl AS SELECT * FROM %s
-                    WHERE control_id = '%s';''' % (table_name, table_latest_upload)
-                )
-                cur.execute(
-                    '''UPDATE tabl SET control_id = '%s';''' % new_table_latest
-                )
-                cur.execute(
-                    '''INSERT INTO %s SELECT * FROM tabl;''' % table_name
-                )
-                cur.execute(
-                    '''SELECT * FROM %s WHERE control_id = '%s';''' % (table_name, new_table_latest)
-                )
-                cur.execute(
-                    '''SELECT source_file FROM control_table WHERE control_id = '%s';''' % (table_latest_upload)
-                )
-                source_file = cur.fetchone()[0]
-                con.commit()
-                df_2 = pd.DataFrame()
-                df_2["control_id"] = [new_table_latest]
-                df_2["source_file"] = [source_file]
-                df_2["upload"] = [maximum + 1]
-                df_2["insert_date"] = [datetime.datetime.now()]
-                df_2["user_id"] = [os.getlogin()]
-                df_2.to_sql('control_table', con, dtype={'control_id': 'PRIMARY KEY'}, index=False, if_exists='append')
-                con.close()
+                latest_uploads[table_name] = new_upload
 
+    # File manifest, used by the incremental loads
     @staticmethod
-    def get_extension_from_file(file):
-        extension = os.path.splitext(file)[1]
-        return extension
-    @staticmethod
-    def get_max_len_header(header_dict):
-        maks = max(header_dict, key=lambda k: len(header_dict[k]))
-        return maks
+    def _file_signature(file_path, with_hash=True):
+        """
+        :param file_path: the path of the file -> str
+        :param with_hash: compute the sha256 of the content, read by blocks of 1MB -> bool
+        :return: {'size': int, 'mtime': float, 'hash': str or None}
+        """
+        stat = os.stat(file_path)
+        file_hash = None
+        if with_hash:
+            sha = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(functools.partial(f.read, 1 << 20), b''):
+                    sha.update(block)
+            file_hash = sha.hexdigest()
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash}
+
+    def _get_file_manifest(self, file_path, table_name):
+        """
+        :param file_path: the path of the file -> str
+        :param table_name: the table the file was inserted in -> str
+        :return: the latest file_manifest row of the file for this table as a dict, None if it was never inserted
+        """
+        if not self._check_if_table_exists('file_manifest'):
+            return None
+        cur = self._get_connection().execute(
+            '''SELECT rowid, control_id, size, mtime, hash FROM file_manifest WHERE table_name = ? AND file_path = ?
+            ORDER BY rowid DESC LIMIT 1;''', (table_name, os.path.abspath(file_path)))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(('rowid', 'control_id', 'size', 'mtime', 'hash'), row))
+
+    def _get_file_status(self, file_path, table_name):
+        """
+        compares a file with its latest manifest row, the content is only hashed when the size or mtime changed,
+        if only the mtime changed (file touched or copied) the manifest row takes the new mtime
+        :param file_path: the path of the file -> str
+        :param table_name: the table the file is inserted in -> str
+        :return: 'new', 'changed' or 'unchanged'
+        """
+        manifest = self._get_file_manifest(file_path, table_name)
+        if manifest is None:
+            return 'new'
+        signature = self._file_signature(file_path, with_hash=False)
+        if signature['size'] == manifest['size'] and signature['mtime'] == manifest['mtime']:
+            return 'unchanged'
+        if self._file_signature(file_path)['hash'] == manifest['hash']:
+            con = self._get_connection()
+            con.execute('UPDATE file_manifest SET size = ?, mtime = ? WHERE rowid = ?;',
+                        (signature['size'], signature['mtime'], manifest['rowid']))
+            if not self._in_transaction():
+                con.commit()
+            return 'unchanged'
+        return 'changed'
+
+    def _record_file_manifest(self, file_path, table_names):
+        """
+        writes a file_manifest row for the file and the latest upload of each table it was inserted in
+        :param file_path: the path of the file -> str
+        :param table_names: the tables the file was inserted in, '' are ignored -> list
+        """
+        con = self._get_connection()
+        if not self._check_if_table_exists('file_manifest'):
+            con.execute(FILE_MANIFEST_DDL)
+            con.execute(FILE_MANIFEST_INDEX_DDL)
+            self._get_metadata()['tables'].add('file_manifest')
+        signature = self._file_signature(file_path)
+        for table_name in table_names:
+            if table_name != '':
+                con.execute(
+                    '''INSERT INTO file_manifest (control_id, table_name, file_path, size, mtime, hash, insert_date)
+                    VALUES (?, ?, ?, ?, ?, ?, ?);''',
+                    (table_name + str(self._get_latest_upload(table_name)), table_name, os.path.abspath(file_path),
+                     signature['size'], signature['mtime'], signature['hash'],
+                     datetime.datetime.now().isoformat(sep=' ')))
+        if not self._in_transaction():
+            con.commit()
+
+    def _delete_previous_file_rows(self, file_path, table_names, source=''):
+        """
+        deletes the rows a file brought in its previous upload of each table, used to replace a changed file
+        :param file_path: the path of the file -> str
+        :param table_names: the tables the file was inserted in, '' are ignored -> list
+        :param source: if given only the rows of this source column value are deleted (folder uploads gather
+        several files in one upload) -> str
+        """
+        con = self._get_connection()
+        for table_name in table_names:
+            manifest = self._get_file_manifest(file_path, table_name) if table_name != '' else None
+            if manifest is not None and self._check_if_table_exists(table_name):
+                if source != '':
+                    con.execute('DELETE FROM "%s" WHERE control_id = ? AND source = ?;' % table_name,
+                                (manifest['control_id'], source))
+                else:
+                    con.execute('DELETE FROM "%s" WHERE control_id = ?;' % table_name, (manifest['control_id'],))
+        self.clear_query_cache([table_name for table_name in table_names if table_name != ''])
+        if not self._in_transaction():
+            con.commit()
+
+    @staticmethod
+    def get_extension_from_file(file):
+        extension = os.path.splitext(file)[1]
+        return extension
+    @staticmethod
+    def get_max_len_header(header_dict):
+        maks = max(header_dict, key=lambda k: len(header_dict[k]))
+        return maks
 
     def insert_DataFrame_to_sqlite_table(
             self,
@@ -312,7 +1914,16 @@ class Pipeline:
             list_col_to_split='',
             list_splitters='',
             col_control_id='',
-            list_column_split_rename=''
+            list_column_split_rename='',
+            atomic=False,
+            bulk=False,
+            chunksize=100000,
+            bulk_pragmas=None,
+            new_upload=True,
+            split_regex=False,
+            schema='',
+            merge_keys='',
+            validation=''
     ):
         """
         inserts the dataframe given to the database, when doing so their will be:
@@ -330,35 +1941,307 @@ class Pipeline:
         :param list_splitters: the splitters used to split (see field_split_method)
         :param col_control_id: the id_column to add to the split table (see field_split_method)
         :param list_column_split_rename: how to rename the column once it was split (see field_split_method)
+        :param atomic: if True the control_table rows, the split tables and the table itself are written in one
+        single transaction with one commit, nothing is written if any step fails -> bool
+        :param bulk: if True the load is done as a bulk load: one transaction, rows sent by chunks of chunksize
+        through executemany and bulk_pragmas switched on for the load, the throughput is printed -> bool
+        :param chunksize: number of rows per executemany call in bulk mode -> int
+        :param bulk_pragmas: the pragmas used during a bulk load, BULK_LOAD_PRAGMAS if None, {} to keep the
+        connection settings. They are only switched when the load isn't already inside a transaction -> dict
+        :param new_upload: if False no control_table row is created and the df is appended to the latest upload
+        of the table, used to load a file chunk by chunk under one upload id -> bool
+        :param split_regex: if True the splitters of list_splitters are regular expressions (see field_split_method)
+        -> bool
+        :param schema: the column types of the table: '' for the types of the dataframe dtypes, 'infer' to infer
+        them from a sample of the values, or the declared types {column: type} (e.g. {'price': 'REAL',
+        'date': 'date'}) keyed by the column names of the file or their formatted names, the declared columns are
+        cast before the insert (see _get_schema) -> '', 'infer' or dict
+        :param merge_keys: if given the dataframe is merged into the table on these columns instead of appended:
+        new keys are inserted, changed rows updated, identical rows skipped, see _merge_dataframe. The split table
+        is still appended -> list
+        :param validation: the rules the rows are checked against before the split and the write, see
+        _validate_dataframe. The failing rows aren't inserted, they go to the table <table_name>_quarantine with
+        the control_id of the upload and the rules they failed, their count is kept in the control_table -> dict
+        :return: a dict with the number of rows written, the time spent and the rows per second, the inserted,
+        updated, unchanged and duplicates counts when merging and the quarantined count when validating
         """
-        con = sqlite3.connect(self.db_path)
-        df.columns = [self._field_name_to_db_format(item)
-                      for item in list(df)]
-        if self._check_if_table_exists(table_name):
-            self._create_control_table(source, table_name)
-            self._insert_control_columns_to_df(df, table_name)
-            if list_col_to_split != '':
-                self._field_split(source,
-                                 list_col_to_split,
-                                 df,
-                                 list_splitters,
-                                 table_split_name,
-                                 list_column_split_rename,
-                                 col_control_id)
-            df.to_sql(table_name, con, index=False, if_exists='append')
-        else:
+        return self._insert_dataframe(df, table_name, source, table_split_name, list_col_to_split, list_splitters,
+                                      col_control_id, list_column_split_rename, atomic, bulk, chunksize, bulk_pragmas,
+                                      new_upload, split_regex, schema, merge_keys, validation)[0]
+
+    def _insert_dataframe(
+            self,
+            df,
+            table_name,
+            source,
+            table_split_name='',
+            list_col_to_split='',
+            list_splitters='',
+            col_control_id='',
+            list_column_split_rename='',
+            atomic=False,
+            bulk=False,
+            chunksize=100000,
+            bulk_pragmas=None,
+            new_upload=True,
+            split_regex=False,
+            schema='',
+            merge_keys='',
+            validation=''
+    ):
+        """
+        insert_DataFrame_to_sqlite_table, also returning the dataframe written: the valid rows with their casts when
+        validating
+        :return: the stats of insert_DataFrame_to_sqlite_table and the dataframe written -> (dict, pandas.DataFrame
+        object)
+        """
+        start = time.perf_counter()
+        with self._stage('format_columns', table_name, len(df)):
+            df.columns = self._format_column_names(list(df), self.column_collision_policy)
+            if merge_keys != '':
+                merge_keys = [self._field_name_to_db_format(key) for key in merge_keys]
+            if isinstance(schema, dict):
+                schema = {self._field_name_to_db_format(col): sql_type for col, sql_type in schema.items()}
+        if not self._check_if_table_exists(table_name):
             print('la table n existe pas, creation de la table')
-            self._create_control_table(source, table_name)
-            self._insert_control_columns_to_df(df, table_name)
+        if bulk and not self._in_transaction():
+            pragmas = self._temporary_pragmas(BULK_LOAD_PRAGMAS if bulk_pragmas is None else bulk_pragmas)
+        else:
+            pragmas = contextlib.nullcontext()
+        counts = {}
+        with pragmas, (self.transaction() if atomic or bulk or merge_keys != '' or validation != ''
+                       else contextlib.nullcontext()):
+            with self._stage('control_table', table_name):
+                if new_upload:
+                    self._create_control_table(source, table_name)
+                self._insert_control_columns_to_df(df, table_name)
+            if validation != '':
+                with self._stage('validate', table_name, len(df)):
+                    control_id = table_name + str(self._get_latest_upload(table_name))
+                    df, quarantine = self._validate_dataframe(df, validation)
+                    counts['quarantined'] = self._write_quarantine(quarantine, table_name, control_id)
             if list_col_to_split != '':
-                self._field_split(source,
-                                 list_col_to_split,
-                                 df,
-                                 list_splitters,
-                                 table_split_name,
-                                 list_column_split_rename,
-                                 col_control_id)
-            df.to_sql(table_name, con, index=False, if_exists='append')
+                with self._stage('split', table_split_name, len(df)):
+                    self._field_split(source,
+                                     list_col_to_split,
+                                     df,
+                                     list_splitters,
+                                     table_split_name,
+                                     list_column_split_rename,
+                                     col_control_id,
+                                     new_upload,
+                                     split_regex)
+            with self._stage('write', table_name, len(df)):
+                if merge_keys != '':
+                    counts = self._merge_dataframe(df, table_name, merge_keys, schema, chunksize if bulk else None)
+                    rows = counts.pop('rows')
+                else:
+                    rows = self._write_dataframe(df, table_name, schema, chunksize=chunksize if bulk else None)
+        seconds = time.perf_counter() - start
+        stats = {'table_name': table_name, 'rows': rows, 'seconds': seconds,
+                 'rows_per_sec': rows / seconds if seconds else float('inf'), **counts}
+        if bulk:
+            print('%s: %d rows in %.2fs (%.0f rows/sec)' % (table_name, rows, seconds, stats['rows_per_sec']))
+        return stats, df
+
+    def insert_DataFrames_to_sqlite_tables(self, list_dataframes):
+        """
+        inserts several dataframes in one single transaction, either all of them are written or none is
+        :param list_dataframes: a list of dicts holding the arguments of insert_DataFrame_to_sqlite_table -> list
+        :return:
+            pipeline.insert_DataFrames_to_sqlite_tables([
+                {'df': df_a, 'table_name': 'table_a', 'source': 'a.csv'},
+                {'df': df_b, 'table_name': 'table_b', 'source': 'b.csv', 'list_col_to_split': ['tags'], ...},
+            ])
+        """
+        with self.transaction():
+            for kwargs in list_dataframes:
+                self.insert_DataFrame_to_sqlite_table(**kwargs)
+
+    def insert_DataFrame_chunks_to_sqlite_table(
+            self,
+            chunks,
+            table_name,
+            source,
+            table_split_name='',
+            list_col_to_split='',
+            list_splitters='',
+            col_control_id='',
+            list_column_split_rename='',
+            schema='',
+            merge_keys='',
+            validation=''
+    ):
+        """
+        inserts an iterable of dataframes (e.g. the reader returned by pandas.read_csv(..., chunksize=...)) as one
+        single upload: the first chunk creates the control_table rows, the next ones are appended under the same
+        control_id, each chunk goes through the same column formatting and split as insert_DataFrame_to_sqlite_table.
+        Only one chunk is held in memory at a time and the whole upload is written in one transaction
+        :param chunks: the dataframes to insert -> iterable of pandas.DataFrame objects
+        :param table_name: the name of the table in the database -> str
+        :param source: the source of the dataframes, csv_path, json_path, ... -> str
+        :param table_split_name: the name of the new table if their is a split (see field_split_method)
+        :param list_col_to_split: the list of column that will be split (see field_split_method)
+        :param list_splitters: the splitters used to split (see field_split_method)
+        :param col_control_id: the id_column to add to the split table (see field_split_method)
+        :param list_column_split_rename: how to rename the column once it was split (see field_split_method)
+        :param schema: the column types of the table, a table created by the first chunk gets the types inferred
+        from it (see insert_DataFrame_to_sqlite_table) -> '', 'infer' or dict
+        :param merge_keys: merges each chunk into the table on these columns, see insert_DataFrame_to_sqlite_table
+        -> list
+        :param validation: the rules each chunk is checked against, see insert_DataFrame_to_sqlite_table -> dict
+        :return: a dict with the number of rows written, the time spent and the rows per second, and the merge
+        and quarantine counts summed over the chunks
+        """
+        start = time.perf_counter()
+        rows = 0
+        counts = collections.Counter()
+        with self.transaction():
+            for i, chunk in enumerate(chunks):
+                stats = self.insert_DataFrame_to_sqlite_table(
+                    chunk,
+                    table_name,
+                    source,
+                    table_split_name,
+                    list_col_to_split,
+                    list_splitters,
+                    col_control_id,
+                    list_column_split_rename,
+                    new_upload=i == 0,
+                    schema=schema,
+                    merge_keys=merge_keys,
+                    validation=validation
+                )
+                rows += stats['rows']
+                counts.update({key: stats[key] for key in ('inserted', 'updated', 'unchanged', 'duplicates',
+                                                           'quarantined') if key in stats})
+        seconds = time.perf_counter() - start
+        return {'table_name': table_name, 'rows': rows, 'seconds': seconds,
+                'rows_per_sec': rows / seconds if seconds else float('inf'), **counts}
+
+    def _insert_file_to_sqlite_table(self, read, file_path, table_name, table_split_name, list_col_to_split,
+                                     list_splitters, col_control_id, list_column_split_rename, incremental=False,
+                                     replace_changed=False, schema='', merge_keys='', validation='', parsed=''):
+        """
+        reads a file and inserts it with its file_manifest row in one transaction, the reader may return a
+        dataframe or a chunk reader when a chunksize was given
+        :param read: called without arguments to read the file, returns a pandas.DataFrame object or a pandas reader
+        object (TextFileReader, JsonReader) -> callable
+        :param file_path: the path of the file, used as source -> str
+        :param incremental: if True the file is skipped when the file_manifest shows it was already inserted in
+        the table and hasn't changed since -> bool
+        :param replace_changed: if True the rows the previous version of a changed file brought are deleted -> bool
+        :param parsed: the start date and the seconds of the parse when read only hands over a dataframe parsed
+        beforehand (see AsyncPipeline._load), the read stage records them -> tuple
+        the other params are the ones of insert_DataFrame_to_sqlite_table
+        :return: the stats of the insert, None if the file was skipped
+        """
+        status = self._get_file_status(file_path, table_name) if incremental else 'new'
+        if status == 'unchanged':
+            print('fichier inchange, ignore: %s' % file_path)
+            return None
+        with self._stage('read', table_name, bytes_=os.path.getsize(file_path)) as event:
+            data = read()
+            if parsed != '':
+                event['start_date'], event['seconds'] = parsed
+            if isinstance(data, pd.DataFrame):
+                event['rows'] = len(data)
+                if self.low_memory:
+                    self._shrink_dataframe(data)
+        with self.transaction():
+            if status == 'changed' and replace_changed:
+                self._delete_previous_file_rows(file_path, [table_name, table_split_name])
+            if isinstance(data, pd.DataFrame):
+                stats = self.insert_DataFrame_to_sqlite_table(data, table_name, file_path, table_split_name,
+                                                              list_col_to_split, list_splitters, col_control_id,
+                                                              list_column_split_rename, schema=schema,
+                                                              merge_keys=merge_keys, validation=validation)
+            else:
+                with data:
+                    stats = self.insert_DataFrame_chunks_to_sqlite_table(data, table_name, file_path,
+                                                                         table_split_name, list_col_to_split,
+                                                                         list_splitters, col_control_id,
+                                                                         list_column_split_rename, schema,
+                                                                         merge_keys, validation)
+            self._record_file_manifest(file_path, [table_name, table_split_name])
+        return stats
+
+    @staticmethod
+    def _get_excel_engine(engine=''):
+        """
+        :param engine: the engine asked, '' picks calamine (rust, several times faster) when python-calamine is
+        installed, else lets pandas pick from the extension: openpyxl for xlsx/xlsm, which pandas opens read-only
+        and streams row by row, xlrd for xls, pyxlsb for xlsb, odf for ods -> str
+        :return: the engine given to pandas, None to let pandas pick
+        """
+        if engine != '':
+            return engine
+        return 'calamine' if python_calamine is not None else None
+
+    @staticmethod
+    def _read_excel(excel_path, sheet_name='', list_column_rename='', skiprows='', engine='', workbooks=None):
+        """
+        reads a sheet of an excel file
+        :param excel_path: the path of the excel file -> str
+        :param sheet_name: the sheet to read, the first one if '' -> str
+        :param list_column_rename: the column names to use instead of the header -> list
+        :param skiprows: the rows to skip -> list-like, int, or callable
+        :param engine: the engine reading the file, see _get_excel_engine -> str
+        :param workbooks: the workbooks already opened {excel_path: pandas.ExcelFile object}, the file is opened
+        once and added to it if missing so the next sheets of the file don't open it again, the caller closes
+        them -> dict
+        :return: pandas.DataFrame object
+        """
+        kwargs = {'sheet_name': 0 if sheet_name == '' else sheet_name}
+        if list_column_rename != '':
+            kwargs['names'] = list_column_rename
+        if skiprows != '':
+            kwargs['skiprows'] = skiprows
+        engine = Pipeline._get_excel_engine(engine)
+        if workbooks is None:
+            return pd.read_excel(excel_path, engine=engine, **kwargs)
+        workbook = workbooks.get(excel_path)
+        if workbook is None:
+            workbook = workbooks[excel_path] = pd.ExcelFile(excel_path, engine=engine)
+        return workbook.parse(**kwargs)
+
+    @staticmethod
+    def _read_csv(csv_path, list_column_rename='', chunksize=''):
+        """
+        reads a csv file, in one dataframe or chunk by chunk if a chunksize is given
+        :param csv_path: the path of the csv file -> str
+        :param list_column_rename: the column names to use instead of the header -> list
+        :param chunksize: the number of rows per chunk, the whole file at once if '' -> int
+        :return: pandas.DataFrame object or pandas TextFileReader object
+        """
+        kwargs = {'sep': ','}
+        if list_column_rename != '':
+            kwargs['names'] = list_column_rename
+        if chunksize not in ('', None):
+            kwargs['chunksize'] = chunksize
+        return pd.read_csv(csv_path, **kwargs)
+
+    @staticmethod
+    def _read_json(json_path, list_column_rename='', lines=False, chunksize=''):
+        """
+        reads a json file, in one dataframe or chunk by chunk if a chunksize is given (json lines only)
+        :param json_path: the path of the json file -> str
+        :param list_column_rename: the column names to give to the dataframe -> list
+        :param lines: True if the json is written in lines -> bool
+        :param chunksize: the number of lines per chunk, the whole file at once if '' -> int
+        :return: pandas.DataFrame object or a pandas JsonReader object
+        """
+        if chunksize not in ('', None):
+            if not lines:
+                raise ValueError('a chunksize can only be used with json lines files (lines=True): %s' % json_path)
+            reader = pd.read_json(json_path, lines=True, chunksize=chunksize)
+            if list_column_rename != '':
+                return _RenamedChunks(reader, list_column_rename)
+            return reader
+        df = pd.read_json(json_path, lines=lines)
+        if list_column_rename != '':
+            df.columns = list_column_rename
+        return df
 
     def insert_excel_data_to_sqlite_table(self,
                                           yaml_file='',
@@ -371,7 +2254,13 @@ class Pipeline:
                                           _list_splitters='',
                                           _col_control_id='',
                                           _list_column_split_rename='',
-                                          _skiprows=''
+                                          _skiprows='',
+                                          incremental=False,
+                                          replace_changed=False,
+                                          _schema='',
+                                          workers=1,
+                                          _merge_keys='',
+                                          _validation=''
                                           ):
         """
         Insert an excel table in the database
@@ -387,11 +2276,24 @@ class Pipeline:
         :param _list_column_split_rename: how to rename the column once it was split (see field_split_method)
         :param _skiprows: if the table on the sheet is not isolated, you can ignore certain rows 
         -> list-like, int, or callable
+        :param incremental: if True the files already inserted in their table and unchanged since (same size and
+        mtime, or same content hash) are skipped, see the file_manifest table -> bool
+        :param replace_changed: in incremental mode, deletes the rows the previous version of a changed file
+        brought before inserting it again -> bool
+        :param _schema: the column types of the table, see insert_DataFrame_to_sqlite_table -> '', 'infer' or dict
+        (optional 'schema' list in the yaml file)
+        :param _merge_keys: merges the file into the table on these columns instead of appending it, see
+        insert_DataFrame_to_sqlite_table -> list (optional 'merge_keys' list in the yaml file)
+        :param _validation: the rules the rows are checked against, the failing rows go to the quarantine table,
+        see insert_DataFrame_to_sqlite_table -> dict (optional 'validation' list in the yaml file)
+        :param workers: the number of processes parsing the sheets of the yaml file in parallel, each process opens
+        a workbook once for all the sheets of it it gets. With 1 the sheets are parsed one after the other and each
+        workbook is opened once for all its sheets and closed after the last one -> int
         :return:
         """
         if yaml_file != '':
-            yaml_file = open(yaml_file)
-            yaml_content = yaml.load(yaml_file)
+            with open(yaml_file) as f:
+                yaml_content = yaml.safe_load(f)
             yaml_dict = yaml_content['Pipeline_dict']
             excel_path = yaml_dict['excel_path']
             sheet_name = yaml_dict['sheet_name']
@@ -403,56 +2305,72 @@ class Pipeline:
             table_split_name = yaml_dict['table_split_name']
             list_column_split_rename = yaml_dict['list_column_split_rename']
             skiprows = yaml_dict['skiprows']
-            for i in range(len(sheet_name)):
-                table_name_ = table_name[i]
-                table_split_name_ = table_split_name[i]
-                sheet_name_ = sheet_name[i]
-                excel_path_ = excel_path[i]
-                list_column_rename_ = list_column_rename[i]
-                list_col_to_split_ = list_col_to_split[i]
-                list_splitters_ = list_splitters[i]
-                col_control_id_ = col_control_id[i]
-                list_column_split_rename_ = list_column_split_rename[i]
-                skiprows_ = skiprows[i]
-                con = sqlite3.connect(self.db_path)
-                if list_column_rename_ != '':
-                    df = pd.read_excel(excel_path_, sheet_name_, names=list_column_rename_, skiprows=skiprows_)
-                else:
-                    df = pd.read_excel(excel_path_, sheet_name_, skiprows=skiprows_)
-                self.insert_DataFrame_to_sqlite_table(
-                    df,
-                    table_name_,
-                    excel_path_,
-                    table_split_name_,
-                    list_col_to_split_,
-                    list_splitters_,
-                    col_control_id_,
-                    list_column_split_rename_
-                )
-                con.close()
-        if _excel_path != '':
-            con = sqlite3.connect(self.db_path)
-            if _sheet_name != '':
-                if _list_column_rename != '':
-                    df = pd.read_excel(_excel_path, _sheet_name, names=_list_column_rename, skiprows=_skiprows)
-                else:
-                    df = pd.read_excel(_excel_path, _sheet_name, skiprows=_skiprows)
+            schema = yaml_dict.get('schema', [''] * len(sheet_name))
+            merge_keys = yaml_dict.get('merge_keys', [''] * len(sheet_name))
+            validation = yaml_dict.get('validation', [''] * len(sheet_name))
+            entries = range(len(sheet_name))
+            if incremental:
+                entries = [i for i in entries
+                           if self._get_file_status(excel_path[i], table_name[i]) != 'unchanged']
+                if len(entries) < len(sheet_name):
+                    print('%d feuilles inchangees ignorees' % (len(sheet_name) - len(entries)))
+            reads = [functools.partial(_read_excel_in_worker if workers > 1 else self._read_excel, excel_path[i],
+                                       sheet_name[i], list_column_rename[i], skiprows[i], self.excel_engine)
+                     for i in entries]
+            workbooks = {}
+            # the last entry reading each file, its workbook is closed once that entry is inserted
+            last_entries = {excel_path[i]: i for i in entries}
+            if workers > 1:
+                dfs = _iter_in_processes(reads, workers)
+                reads = (functools.partial(_identity, df) for df in dfs)
             else:
-                if _list_column_rename != '':
-                    df = pd.read_excel(_excel_path, names=_list_column_rename, skiprows=_skiprows)
-                else:
-                    df = pd.read_excel(_excel_path, skiprows=_skiprows)
-            self.insert_DataFrame_to_sqlite_table(
-                df,
-                _table_name,
+                reads = [functools.partial(read, workbooks=workbooks) for read in reads]
+            try:
+                for i, read in zip(entries, reads):
+                    table_name_ = table_name[i]
+                    table_split_name_ = table_split_name[i]
+                    excel_path_ = excel_path[i]
+                    list_col_to_split_ = list_col_to_split[i]
+                    list_splitters_ = list_splitters[i]
+                    col_control_id_ = col_control_id[i]
+                    list_column_split_rename_ = list_column_split_rename[i]
+                    self._insert_file_to_sqlite_table(
+                        read,
+                        excel_path_,
+                        table_name_,
+                        table_split_name_,
+                        list_col_to_split_,
+                        list_splitters_,
+                        col_control_id_,
+                        list_column_split_rename_,
+                        incremental,
+                        replace_changed,
+                        schema[i],
+                        merge_keys[i],
+                        validation[i]
+                    )
+                    if last_entries[excel_path_] == i and excel_path_ in workbooks:
+                        workbooks.pop(excel_path_).close()
+            finally:
+                for workbook in workbooks.values():
+                    workbook.close()
+        if _excel_path != '':
+            self._insert_file_to_sqlite_table(
+                functools.partial(self._read_excel, _excel_path, _sheet_name, _list_column_rename, _skiprows,
+                                  self.excel_engine),
                 _excel_path,
+                _table_name,
                 _table_split_name,
                 _list_col_to_split,
                 _list_splitters,
                 _col_control_id,
-                _list_column_split_rename
+                _list_column_split_rename,
+                incremental,
+                replace_changed,
+                _schema,
+                _merge_keys,
+                _validation
             )
-            con.close()
 
     def insert_csv_data_to_sqlite_table(self,
                                         yaml_file='',
@@ -463,7 +2381,13 @@ class Pipeline:
                                         _list_col_to_split='',
                                         _list_splitters='',
                                         _col_control_id='',
-                                        _list_column_split_rename=''
+                                        _list_column_split_rename='',
+                                        _chunksize='',
+                                        incremental=False,
+                                        replace_changed=False,
+                                        _schema='',
+                                        _merge_keys='',
+                                        _validation=''
                                         ):
         """
         insert a csv file to the database
@@ -477,11 +2401,24 @@ class Pipeline:
         :param _list_splitters: the splitters used to split (see field_split_method)
         :param _col_control_id: the id_column to add to the split table (see field_split_method)
         :param _list_column_split_rename: how to rename the column once it was split (see field_split_method)
+        :param _chunksize: if given the file is streamed by chunks of _chunksize rows, all inserted under the same
+        upload, the memory used depends on the chunk size and not on the file size -> int
+        (optional 'chunksize' list in the yaml file)
+        :param incremental: if True the files already inserted in their table and unchanged since (same size and
+        mtime, or same content hash) are skipped, see the file_manifest table -> bool
+        :param replace_changed: in incremental mode, deletes the rows the previous version of a changed file
+        brought before inserting it again -> bool
+        :param _schema: the column types of the table, see insert_DataFrame_to_sqlite_table -> '', 'infer' or dict
+        (optional 'schema' list in the yaml file)
+        :param _merge_keys: merges the file into the table on these columns instead of appending it, see
+        insert_DataFrame_to_sqlite_table -> list (optional 'merge_keys' list in the yaml file)
+        :param _validation: the rules the rows are checked against, the failing rows go to the quarantine table,
+        see insert_DataFrame_to_sqlite_table -> dict (optional 'validation' list in the yaml file)
         :return: 
         """
         if yaml_file != '':
-            yaml_file = open(yaml_file)
-            yaml_content = yaml.load(yaml_file)
+            with open(yaml_file) as f:
+                yaml_content = yaml.safe_load(f)
             yaml_dict = yaml_content['Pipeline_dict']
             csv_path = yaml_dict['csv_path']
             list_col_to_split = yaml_dict['list_col_to_split']
@@ -491,6 +2428,10 @@ class Pipeline:
             table_name = yaml_dict['table_name']
             table_split_name = yaml_dict['table_split_name']
             list_column_split_rename = yaml_dict['list_column_split_rename']
+            chunksize = yaml_dict.get('chunksize', [''] * len(csv_path))
+            schema = yaml_dict.get('schema', [''] * len(csv_path))
+            merge_keys = yaml_dict.get('merge_keys', [''] * len(csv_path))
+            validation = yaml_dict.get('validation', [''] * len(csv_path))
             for i in range(len(csv_path)):
                 table_name_ = table_name[i]
                 table_split_name_ = table_split_name[i]
@@ -500,40 +2441,38 @@ class Pipeline:
                 list_splitters_ = list_splitters[i]
                 col_control_id_ = col_control_id[i]
                 list_column_split_rename_ = list_column_split_rename[i]
-                con = sqlite3.connect(self.db_path)
-                print(list_column_rename_)
-                if list_column_rename_ != '':
-                    df = pd.read_csv(csv_path_, sep=',', names=list_column_rename_)
-                else:
-                    df = pd.read_csv(csv_path_, sep=',')
-                self.insert_DataFrame_to_sqlite_table(
-                    df,
-                    table_name_,
+                chunksize_ = chunksize[i]
+                self._insert_file_to_sqlite_table(
+                    functools.partial(self._read_csv, csv_path_, list_column_rename_, chunksize_),
                     csv_path_,
+                    table_name_,
                     table_split_name_,
                     list_col_to_split_,
                     list_splitters_,
                     col_control_id_,
-                    list_column_split_rename_
+                    list_column_split_rename_,
+                    incremental,
+                    replace_changed,
+                    schema[i],
+                    merge_keys[i],
+                    validation[i]
                 )
-                con.close()
         if _csv_path != '':
-            con = sqlite3.connect(self.db_path)
-            if _list_column_rename != '':
-                df = pd.read_csv(_csv_path, sep=',', names=_list_column_rename)
-            else:
-                df = pd.read_csv(_csv_path, sep=',')
-            self.insert_DataFrame_to_sqlite_table(
-                df,
-                _table_name,
+            self._insert_file_to_sqlite_table(
+                functools.partial(self._read_csv, _csv_path, _list_column_rename, _chunksize),
                 _csv_path,
+                _table_name,
                 _table_split_name,
                 _list_col_to_split,
                 _list_splitters,
                 _col_control_id,
-                _list_column_split_rename
+                _list_column_split_rename,
+                incremental,
+                replace_changed,
+                _schema,
+                _merge_keys,
+                _validation
             )
-            con.close()
 
     def insert_json_data_to_sqlite_table(self,
                                          yaml_file='',
@@ -545,7 +2484,13 @@ class Pipeline:
                                          _list_splitters='',
                                          _col_control_id='',
                                          _list_column_split_rename='',
-                                         _lines=False
+                                         _lines=False,
+                                         _chunksize='',
+                                         incremental=False,
+                                         replace_changed=False,
+                                         _schema='',
+                                         _merge_keys='',
+                                         _validation=''
                                          ):
         """
         insert a json file in the database
@@ -559,11 +2504,23 @@ class Pipeline:
         :param _col_control_id: the id_column to add to the split table (see field_split_method)
         :param _list_column_split_rename: how to rename the column once it was split (see field_split_method)
         :param _lines: Default False, use True if the json is written in lines != json style -> Boolean
+        :param _chunksize: if given the file is streamed by chunks of _chunksize lines, all inserted under the same
+        upload, only available with _lines=True -> int (optional 'chunksize' list in the yaml file)
+        :param incremental: if True the files already inserted in their table and unchanged since (same size and
+        mtime, or same content hash) are skipped, see the file_manifest table -> bool
+        :param replace_changed: in incremental mode, deletes the rows the previous version of a changed file
+        brought before inserting it again -> bool
+        :param _schema: the column types of the table, see insert_DataFrame_to_sqlite_table -> '', 'infer' or dict
+        (optional 'schema' list in the yaml file)
+        :param _merge_keys: merges the file into the table on these columns instead of appending it, see
+        insert_DataFrame_to_sqlite_table -> list (optional 'merge_keys' list in the yaml file)
+        :param _validation: the rules the rows are checked against, the failing rows go to the quarantine table,
+        see insert_DataFrame_to_sqlite_table -> dict (optional 'validation' list in the yaml file)
         :return:
         """
         if yaml_file != '':
-            yaml_file = open(yaml_file)
-            yaml_content = yaml.load(yaml_file)
+            with open(yaml_file) as f:
+                yaml_content = yaml.safe_load(f)
             yaml_dict = yaml_content['Pipeline_dict']
             json_path = yaml_dict['json_path']
             list_column_rename = yaml_dict['list_column_rename']
@@ -574,6 +2531,10 @@ class Pipeline:
             table_split_name = yaml_dict['table_split_name']
             list_column_split_rename = yaml_dict['list_column_split_rename']
             lines = yaml_dict['lines']
+            chunksize = yaml_dict.get('chunksize', [''] * len(table_name))
+            schema = yaml_dict.get('schema', [''] * len(table_name))
+            merge_keys = yaml_dict.get('merge_keys', [''] * len(table_name))
+            validation = yaml_dict.get('validation', [''] * len(table_name))
             for i in range(len(table_name)):
                 table_name_ = table_name[i]
                 table_split_name_ = table_split_name[i]
@@ -584,64 +2545,122 @@ class Pipeline:
                 col_control_id_ = col_control_id[i]
                 list_column_split_rename_ = list_column_split_rename[i]
                 lines_ = lines[i]
-                con = sqlite3.connect(self.db_path)
-                if list_column_rename_ != '':
-                    df = pd.read_json(json_path_, names=list_column_rename_, lines=lines_)
-                else:
-                    df = pd.read_json(json_path_, lines=lines_)
-                self.insert_DataFrame_to_sqlite_table(
-                    df,
-                    table_name_,
+                chunksize_ = chunksize[i]
+                self._insert_file_to_sqlite_table(
+                    functools.partial(self._read_json, json_path_, list_column_rename_, lines_, chunksize_),
                     json_path_,
+                    table_name_,
                     table_split_name_,
                     list_col_to_split_,
                     list_splitters_,
                     col_control_id_,
-                    list_column_split_rename_
+                    list_column_split_rename_,
+                    incremental,
+                    replace_changed,
+                    schema[i],
+                    merge_keys[i],
+                    validation[i]
                 )
-                con.close()
         if _json_path != '':
-            con = sqlite3.connect(self.db_path)
-            if _list_column_rename != '':
-                df = pd.read_json(_json_path, names=_list_column_rename, lines=_lines)
-            else:
-                df = pd.read_json(_json_path, lines=_lines)
-        self.insert_DataFrame_to_sqlite_table(
-            df,
-            _table_name,
-            _json_path,
-            _table_split_name,
-            _list_col_to_split,
-            _list_splitters,
-            _col_control_id,
-            _list_column_split_rename
-        )
-        con.close()
-
-    def insert_files_from_folder_to_sqlite_tables(self, folder_path, sheet_name, table_name):
-        """
-        insert all the EXCEL files in a folder in the database as one single table, please note that the sheet names
-        to insert has to be the same in EACH excel file
+            self._insert_file_to_sqlite_table(
+                functools.partial(self._read_json, _json_path, _list_column_rename, _lines, _chunksize),
+                _json_path,
+                _table_name,
+                _table_split_name,
+                _list_col_to_split,
+                _list_splitters,
+                _col_control_id,
+                _list_column_split_rename,
+                incremental,
+                replace_changed,
+                _schema,
+                _merge_keys,
+                _validation
+            )
+
+    def insert_files_from_folder_to_sqlite_tables(self, folder_path, sheet_name, table_name, workers=1,
+                                                  incremental=False, replace_changed=False, schema='',
+                                                  merge_keys='', validation=''):
+        """
+        insert all the files in a folder in the database as one single table, please note that the sheet names
+        to insert has to be the same in EACH excel file. Excel, csv and json files are read according to their
+        extension (see get_extension_from_file), the other files are ignored
         :param folder_path: the path where the folder is located -> str
         :param sheet_name: the name of the sheet on which the table is located -> str
         :param table_name: the name of the final table in the database -> str
+        :param workers: the number of processes parsing the files in parallel, the frames are then reconciled and
+        written by the current process -> int
+        :param incremental: if True only the files that are new or changed since their last insertion in the table
+        are read and inserted, see the file_manifest table -> bool
+        :param replace_changed: in incremental mode, deletes the rows the previous version of a changed file
+        brought (matched on their Source column) before inserting it again -> bool
+        :param schema: the column types of the table, see insert_DataFrame_to_sqlite_table -> '', 'infer' or dict
+        :param merge_keys: merges the files into the table on these columns, see insert_DataFrame_to_sqlite_table
+        -> list
+        :param validation: the rules the rows are checked against, see insert_DataFrame_to_sqlite_table. When not
+        given and the files share a date column, it is parsed as a date and the rows whose date can't be parsed go
+        to the quarantine table instead of failing the load -> dict
+        :return: the dataframe inserted, without the quarantined rows and with the casts of the validation, None
+        if there was no file to insert. In low_memory mode the files are streamed one by one into the table (see
+        _iter_folder_frames) and the stats of the insert are returned instead (see
+        insert_DataFrame_chunks_to_sqlite_table)
         """
-        file_extensions = []
+        files = []
+        for file in os.listdir(folder_path):
+            if self.get_extension_from_file(file).lower() in EXCEL_EXTENSIONS + CSV_EXTENSIONS + JSON_EXTENSIONS:
+                files.append(file)
+            else:
+                print('fichier ignore: %s' % file)
+        changed_files = []
+        if incremental:
+            status = {file: self._get_file_status(os.path.join(folder_path, file), table_name) for file in files}
+            changed_files = [file for file in files if status[file] == 'changed']
+            files = [file for file in files if status[file] != 'unchanged']
+            if not files:
+                print('aucun fichier nouveau ou modifie dans %s' % folder_path)
+                return None
+        file_paths = [os.path.join(folder_path, file) for file in files]
+        if self.low_memory:
+            headers_dict = {file: _read_folder_header(file_path, sheet_name, self.column_collision_policy,
+                                                      self.excel_engine)
+                            for file, file_path in zip(files, file_paths)}
+            common = min(len(headers) for headers in headers_dict.values())
+            columns = {file: headers[:common] for file, headers in headers_dict.items()}
+            if validation == '' and all('date' in headers for headers in columns.values()):
+                validation = FOLDER_DATE_VALIDATION
+            with self.transaction():
+                if replace_changed:
+                    for file in changed_files:
+                        self._delete_previous_file_rows(os.path.join(folder_path, file), [table_name], source=file)
+                stats = self.insert_DataFrame_chunks_to_sqlite_table(
+                    self._iter_folder_frames(files, file_paths, sheet_name, workers, columns), table_name,
+                    folder_path, schema=schema, merge_keys=merge_keys, validation=validation)
+                for file_path in file_paths:
+                    self._record_file_manifest(file_path, [table_name])
+            return stats
         headers_dict = {}
         df_dict_ = {}
-        for file in os.listdir(folder_path):
-            file_extensions.append(self.get_extension_from_file(file))
-            df = pd.read_excel(os.path.join(folder_path,file), sheet_name)
-            df.columns = [self._field_name_to_db_format(item) for item in list(df)]
-            df_dict_[file] = df
-            headers_dict[file] = [self._field_name_to_db_format(x) for x in list(df)]
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                dfs = executor.map(_read_folder_file, file_paths, [sheet_name] * len(file_paths),
+                                   [self.column_collision_policy] * len(file_paths), [False] * len(file_paths),
+                                   [self.excel_engine] * len(file_paths))
+                for file, df in zip(files, dfs):
+                    df_dict_[file] = df
+                    headers_dict[file] = list(df)
+        else:
+            for file, file_path in zip(files, file_paths):
+                df = _read_folder_file(file_path, sheet_name, self.column_collision_policy,
+                                       excel_engine=self.excel_engine)
+                df_dict_[file] = df
+                headers_dict[file] = list(df)
         columns_ = headers_dict[self.get_max_len_header(headers_dict)]
         df = pd.DataFrame.from_dict(headers_dict, orient='index', columns=columns_)
         df = df.dropna(axis=1)
         df_to_concat = []
         for key in df_dict_:
             list_df_ = list(df.loc[key])
-            list_df_dict = [self._field_name_to_db_format(x) for x in df_dict_[key]]
+            list_df_dict = list(df_dict_[key])
             if  len(list_df_dict) != len(list_df_):
                 columns_to_drop = [i for i in list_df_dict + list_df_ if i not in list_df_dict or i not in list_df_]
                 df_dict_[key] = df_dict_[key].drop(columns_to_drop, axis=1 )
@@ -649,18 +2668,985 @@ class Pipeline:
             print(key)
             df_to_concat.append(df_dict_[key])
         final_df = pd.concat(df_to_concat)
-        final_df['date'] = final_df['date'].astype('datetime64[ns]')
-        self.insert_DataFrame_to_sqlite_table(final_df, table_name=table_name, source=folder_path)
+        if validation == '' and 'date' in final_df.columns:
+            validation = FOLDER_DATE_VALIDATION
+        with self.transaction():
+            if replace_changed:
+                for file in changed_files:
+                    self._delete_previous_file_rows(os.path.join(folder_path, file), [table_name], source=file)
+            final_df = self._insert_dataframe(final_df, table_name, folder_path, schema=schema, merge_keys=merge_keys,
+                                              validation=validation)[1]
+            for file_path in file_paths:
+                self._record_file_manifest(file_path, [table_name])
         return final_df
 
-    def fetch_dataframe_using_query(self, string='', file_path='', table_name=''):
-        con = sqlite3.connect(self.db_path)
+    def _iter_folder_frames(self, files, file_paths, sheet_name, workers, columns):
+        """
+        reads the files of a folder load in order and yields each one with only the columns kept and its Source
+        column, a frame is released once the insert consumed it. With workers > 1 the files are parsed by a process
+        pool, no more than workers files ahead of the insert
+        :param files: the names of the files -> list
+        :param file_paths: their paths -> list
+        :param sheet_name: the sheet to read for excel files -> str
+        :param workers: the number of processes parsing the files -> int
+        :param columns: the columns kept for each file {file: columns} -> dict
+        :return: generator of pandas.DataFrame objects
+        """
+        def prepare(file, df):
+            dropped = [col for col in df.columns if col not in columns[file]]
+            if dropped:
+                df.drop(columns=dropped, inplace=True)
+            df.insert(0, 'Source', pd.Categorical.from_codes(np.zeros(len(df), dtype='int8'), [file]))
+            print(file)
+            return df
+
+        reads = [functools.partial(_read_folder_file, file_path, sheet_name, self.column_collision_policy, True,
+                                   self.excel_engine) for file_path in file_paths]
+        if workers > 1:
+            dfs = _iter_in_processes(reads, workers)
+        else:
+            dfs = (read() for read in reads)
+        for file, df in zip(files, dfs):
+            yield prepare(file, df)
+
+    def enable_query_cache(self, max_entries=128, max_bytes=256 * 2 ** 20, disk_dir='', disk_min_bytes=64 * 2 ** 20,
+                           max_disk_bytes=4 * 2 ** 30):
+        """
+        turns on the cache of fetch_dataframe_using_query: a result is reused as long as the latest uploads of the
+        tables the query reads (found by the sqlite authorizer, views included) haven't changed, so an insert only
+        invalidates the queries reading its table. The queries reading tables the control_table doesn't follow
+        are never cached
+        :param max_entries: the maximum number of results kept in memory -> int
+        :param max_bytes: the maximum size of the results kept in memory -> int
+        :param disk_dir: if given the results of at least disk_min_bytes are stored there as feather files,
+        requires pyarrow -> str
+        :param disk_min_bytes: the size from which a result goes to disk_dir instead of memory -> int
+        :param max_disk_bytes: the maximum size of the files in disk_dir -> int
+        """
+        self._query_cache = _QueryCache(max_entries, max_bytes, disk_dir, disk_min_bytes, max_disk_bytes)
+
+    def clear_query_cache(self, table_names=None):
+        """
+        :param table_names: drops the cached results reading these tables, every result if None -> list
+        """
+        if self._query_cache is not None:
+            self._query_cache.invalidate(table_names)
+
+    @staticmethod
+    def _normalize_query(query):
+        """
+        :return: the query with its whitespaces collapsed and without its trailing semicolon
+        """
+        return ' '.join(query.split()).rstrip(';').rstrip()
+
+    def _get_query_tables(self, query):
+        """
+        compiles the query without running it and collects the tables it reads through the sqlite authorizer,
+        the control_table read by a <table>_latest view counts as a read of <table>
+        :param query: the sql query -> str
+        :return: set of table names
+        """
+        con = self._get_connection()
+        tables = set()
+
+        def authorizer(action, arg1, arg2, db_name, view_name):
+            if action == sqlite3.SQLITE_READ:
+                if arg1 == 'control_table' and view_name is not None and view_name.endswith('_latest'):
+                    tables.add(view_name[:-len('_latest')])
+                else:
+                    tables.add(arg1)
+            return sqlite3.SQLITE_OK
+
+        con.set_authorizer(authorizer)
+        try:
+            con.execute('EXPLAIN ' + query)
+        finally:
+            con.set_authorizer(None)
+        return tables
+
+    def _get_query_cache_key(self, query):
+        """
+        :return: (key, tables) for the query, key is None if the query can't be cached
+        """
+        normalized = self._normalize_query(query)
+        tables = self._get_query_tables(normalized)
+        latest_uploads = self._get_metadata()['latest_uploads']
+        if 'control_table' in tables:
+            versions = tuple(sorted(latest_uploads.items()))
+        elif tables and all(table in latest_uploads for table in tables):
+            versions = tuple(sorted((table, latest_uploads[table]) for table in tables))
+        else:
+            return None, tables
+        return (normalized, versions), tables
+
+    @staticmethod
+    def _get_query(string='', file_path='', table_name=''):
+        """
+        :return: the sql query given directly, read from file_path, or reading table_name entirely, None if none
+        """
         if string != '':
-            return pd.read_sql_query(string, con)
+            return string
         if file_path != '':
             with open(file_path, 'r') as f:
-                lines = f.read()
-                return pd.read_sql_query(lines, con)
+                return f.read()
         if table_name != '':
-            return pd.read_sql_table(table_name, con)
+            return 'SELECT * FROM "%s"' % table_name
+        return None
+
+    @staticmethod
+    def _require_pyarrow():
+        if pa is None:
+            raise ImportError('pyarrow is required for the arrow and parquet outputs: pip install pyarrow')
+
+    def _iter_query(self, query, chunksize, output='pandas'):
+        """
+        runs the query and yields its result by chunks of chunksize rows, only one chunk is held in memory
+        :param query: the sql query -> str
+        :param chunksize: the number of rows per chunk -> int
+        :param output: 'pandas' yields DataFrames, 'arrow' pyarrow RecordBatches, 'rows' lists of tuples -> str
+        """
+        con = self._get_connection()
+        if output == 'rows':
+            cur = con.execute(query)
+            try:
+                while True:
+                    rows = cur.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cur.close()
+            return
+        if output == 'arrow':
+            self._require_pyarrow()
+        for chunk in pd.read_sql_query(query, con, chunksize=chunksize):
+            yield chunk if output == 'pandas' else pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+    def fetch_dataframe_using_query(self, string='', file_path='', table_name='', use_cache=True, chunksize='',
+                                    output='pandas'):
+        """
+        runs a query and returns its result
+        :param string: the sql query -> str
+        :param file_path: the path of a file containing the sql query -> str
+        :param table_name: the table to read entirely -> str
+        :param use_cache: use the query cache if it was turned on (see enable_query_cache) -> bool
+        :param chunksize: if given an iterator over chunks of chunksize rows is returned instead, so the result is
+        never held entirely in memory (not cached) -> int
+        :param output: 'pandas' for DataFrames, 'arrow' for a pyarrow Table (RecordBatches by chunk), 'rows' for
+        lists of tuples (by chunk only) -> str
+        :return: pandas.DataFrame object, pyarrow.Table object, or an iterator of chunks
+        """
+        query = self._get_query(string, file_path, table_name)
+        if query is None:
+            return None
+        if chunksize != '':
+            return self._iter_query(query, chunksize, output)
+        if output == 'arrow':
+            self._require_pyarrow()
+        con = self._get_connection()
+        with self._stage('query', table_name) as event:
+            if self._query_cache is None or not use_cache:
+                df = pd.read_sql_query(query, con)
+            else:
+                key, tables = self._get_query_cache_key(query)
+                df = self._query_cache.get(key) if key is not None else None
+                if df is None:
+                    df = pd.read_sql_query(query, con)
+                    if key is not None:
+                        self._query_cache.put(key, tables, df)
+            event['rows'] = len(df)
+        if output == 'arrow':
+            return pa.Table.from_pandas(df, preserve_index=False)
+        return df
+
+    def export_query_to_file(self, path, string='', file_path='', table_name='', chunksize=100000, file_format=''):
+        """
+        writes the result of a query to a parquet or csv file chunk by chunk, the memory used depends on the chunk
+        size and not on the size of the result
+        :param path: the path of the file to write -> str
+        :param string: the sql query -> str
+        :param file_path: the path of a file containing the sql query -> str
+        :param table_name: the table to export entirely -> str
+        :param chunksize: the number of rows read and written at a time -> int
+        :param file_format: 'parquet' or 'csv', found from the extension of path if '' -> str
+        :return: the number of rows written
+        """
+        query = self._get_query(string, file_path, table_name)
+        if file_format == '':
+            file_format = 'parquet' if self.get_extension_from_file(path).lower() in ('.parquet', '.pq') else 'csv'
+        rows = 0
+        if file_format == 'csv':
+            for i, chunk in enumerate(self._iter_query(query, chunksize)):
+                chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+                rows += len(chunk)
+            return rows
+        self._require_pyarrow()
+        return self._write_parquet(path, query, chunksize, self._get_table_types(table_name) if table_name else None)
+
+    def _get_arrow_schema(self, query, declared=None, scan=False):
+        """
+        the arrow type of each column of the result of the query. The columns with a declared INTEGER, REAL, TEXT
+        or date type take its type, the others get the type of the sqlite storage classes of all their values
+        (typeof), read in one more pass over the query: int64 for integers only, float64 for numbers, binary for
+        blobs, string for text and for the columns mixing text with other values. The columns without any value
+        get the type of their declared type
+        :param query: the sql query -> str
+        :param declared: the declared types of the columns, every column is typed from its values if None -> dict
+        :param scan: types every column from its values, even the declared ones -> bool
+        :return: pyarrow.Schema object, and the set of the string columns holding other values than text
+        """
+        con = self._get_connection()
+        query = query.strip().rstrip(';')
+        names = [column[0] for column in con.execute('SELECT * FROM (%s) LIMIT 0;' % query).description]
+        aliases = ['c%d' % i for i in range(len(names))]
+        declared = declared or {}
+        storage = {}
+        for name in names:
+            if scan or name not in declared:
+                continue
+            sql_type = self._normalize_sql_type(declared[name])
+            affinity = self._get_affinity(sql_type)
+            if affinity in ('INTEGER', 'REAL', 'TEXT'):
+                storage[name] = {affinity.lower()}
+            elif 'DATE' in sql_type or 'TIME' in sql_type:
+                # the dates are written as iso text
+                storage[name] = {'text'}
+        scanned = [(name, alias) for name, alias in zip(names, aliases) if name not in storage]
+        if scanned:
+            selected = ', '.join("coalesce(group_concat(DISTINCT typeof(%s)), '')" % alias for _, alias in scanned)
+            row = con.execute('WITH q(%s) AS (%s) SELECT %s FROM q;' % (', '.join(aliases), query, selected)).fetchone()
+            for (name, _), storage_classes in zip(scanned, row):
+                storage[name] = set(storage_classes.split(',')) - {'', 'null'}
+        fields = []
+        mixed = set()
+        for name in names:
+            storage_classes = storage[name]
+            if not storage_classes:
+                affinity = self._get_affinity(self._normalize_sql_type(declared.get(name, 'TEXT')))
+                storage_classes = {affinity.lower()} if affinity in ('INTEGER', 'REAL') else {'text'}
+            if storage_classes == {'integer'}:
+                type_ = pa.int64()
+            elif storage_classes <= {'integer', 'real'}:
+                type_ = pa.float64()
+            elif storage_classes == {'blob'}:
+                type_ = pa.binary()
+            else:
+                type_ = pa.string()
+                if storage_classes != {'text'}:
+                    mixed.add(name)
+            fields.append(pa.field(name, type_))
+        return pa.schema(fields), mixed
+
+    def _write_parquet(self, path, query, chunksize, declared=None, metadata=None):
+        """
+        writes the result of the query to a parquet file chunk by chunk, typed by _get_arrow_schema from the
+        declared types of its columns when they are given. sqlite doesn't enforce the declared types, when a value
+        doesn't fit the type of its column the file is written again with every column typed from its values
+        :param path: the path of the parquet file to write -> str
+        :param query: the sql query -> str
+        :param chunksize: the number of rows read and written at a time -> int
+        :param declared: the declared types of the columns of the result, see _get_arrow_schema -> dict
+        :param metadata: added to the metadata of the file -> dict
+        :return: the number of rows written
+        """
+        schema, mixed = self._get_arrow_schema(query, declared)
+        if metadata is not None:
+            schema = schema.with_metadata(metadata)
+        try:
+            return self._write_parquet_chunks(path, query, chunksize, schema, mixed)
+        except pa.ArrowException:
+            if declared is None:
+                raise
+        schema, mixed = self._get_arrow_schema(query, declared, scan=True)
+        if metadata is not None:
+            schema = schema.with_metadata(metadata)
+        return self._write_parquet_chunks(path, query, chunksize, schema, mixed)
+
+    def _write_parquet_chunks(self, path, query, chunksize, schema, mixed):
+        """
+        writes the result of the query to a parquet file chunk by chunk with the schema given, the values of the
+        mixed columns are written as text. The type of the values of each column is checked against the schema
+        since pyarrow would truncate the floats of an int64 column
+        :return: the number of rows written
+        """
+        rows = 0
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in self._iter_query(query, chunksize, 'rows'):
+                arrays = []
+                for field, values in zip(schema, zip(*chunk)):
+                    if field.name in mixed:
+                        values = [value if value is None or isinstance(value, str) else str(value)
+                                  for value in values]
+                    array = pa.array(values)
+                    if array.type == pa.null() or (array.type == pa.int64() and field.type == pa.float64()):
+                        array = array.cast(field.type)
+                    elif array.type != field.type:
+                        raise pa.ArrowInvalid('the column %s holds %s values, not %s' % (
+                            field.name, array.type, field.type))
+                    arrays.append(array)
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows += len(chunk)
+        return rows
+
+    def execute_sql(self, string='', file_path=''):
+        """
+        runs a sql script (CREATE TABLE ... AS SELECT, UPDATE, DELETE, ...), the metadata and query caches are
+        dropped afterwards since the script may change any table. sqlite commits before running a script so it
+        can't be called inside a transaction() block
+        :param string: the sql script -> str
+        :param file_path: the path of a file containing the sql script -> str
+        """
+        if self._in_transaction():
+            raise RuntimeError('execute_sql can not run inside a transaction')
+        self._get_connection().executescript(self._get_query(string, file_path))
+        self._invalidate_metadata()
+        self.clear_query_cache()
+
+
+class AsyncPipeline:
+    """
+    asyncio front of Pipeline for services loading many sources at once: the files are parsed in an executor
+    while one writer task, running on a single dedicated thread, owns the database connection and applies the
+    writes one after the other. At most max_pending dataframes are parsed or waiting to be written at the same
+    time, the next loads wait (back-pressure) until the writer catches up
+        async with AsyncPipeline('db.sqlite') as pipeline:
+            await asyncio.gather(
+                pipeline.insert_csv_data_to_sqlite_table(_csv_path='a.csv', _table_name='table_a'),
+                pipeline.insert_excel_data_to_sqlite_table(_excel_path='b.xlsx', _table_name='table_b'),
+            )
+    """
+    def __init__(self, db_path, max_pending=8, parse_executor=None, **pipeline_kwargs):
+        """
+        :param db_path: the path of the sqlite database -> str
+        :param max_pending: the size of the write queue and the maximum number of dataframes in flight -> int
+        :param parse_executor: the executor parsing the files and running the queries, the event loop default
+        executor if None, a ProcessPoolExecutor can be given for cpu bound parsing -> concurrent.futures.Executor
+        :param pipeline_kwargs: passed to Pipeline (pragmas, timeout, column_collision_policy)
+        """
+        self.pipeline = Pipeline(db_path, **pipeline_kwargs)
+        self.max_pending = max_pending
+        self.parse_executor = parse_executor
+        self._writer_executor = None
+        self._queue = None
+        self._slots = None
+        self._writer_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self):
+        """
+        starts the writer task, called by the first load if it wasn't called before
+        """
+        if self._writer_task is None:
+            self._writer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._slots = asyncio.Semaphore(self.max_pending)
+            self._writer_task = asyncio.get_running_loop().create_task(self._writer())
+
+    async def close(self):
+        """
+        waits for the queued writes, stops the writer task and closes the connections
+        """
+        if self._writer_task is not None:
+            await self._queue.put(None)
+            await self._writer_task
+            self._writer_task = None
+            await asyncio.get_running_loop().run_in_executor(self._writer_executor, self.pipeline.close)
+            self._writer_executor.shutdown()
+        self.pipeline.close()
+
+    async def _writer(self):
+        """
+        the writer task: runs the queued writes one at a time on the writer thread
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job is None:
+                break
+            func, future = job
+            try:
+                result = await loop.run_in_executor(self._writer_executor, func)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    async def _write(self, func):
+        """
+        queues a write for the writer task and waits for its result, waits first if the queue is full
+        :param func: the write, called without arguments on the writer thread -> callable
+        """
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, future))
+        return await future
+
+    async def _parse(self, func):
+        """
+        :param func: the parsing, called without arguments in the parse executor -> callable
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.parse_executor, func)
+
+    async def _load(self, read, file_path, table_name, table_split_name, list_col_to_split, list_splitters,
+                    col_control_id, list_column_split_rename, schema='', incremental=False, replace_changed=False,
+                    merge_keys='', validation=''):
+        """
+        parses the file in the executor then queues its insert, holding one of the max_pending slots meanwhile.
+        In incremental mode the file_manifest is checked first so an unchanged file isn't even parsed
+        :return: the stats of the insert, None if the file was skipped
+        """
+        await self.start()
+        if incremental:
+            status = await self._write(functools.partial(self.pipeline._get_file_status, file_path, table_name))
+            if status == 'unchanged':
+                print('fichier inchange, ignore: %s' % file_path)
+                return None
+        async with self._slots:
+            df, start_date, seconds = await self._parse(functools.partial(_timed_call, read))
+            return await self._write(functools.partial(
+                self.pipeline._insert_file_to_sqlite_table, functools.partial(_identity, df), file_path,
+                table_name, table_split_name, list_col_to_split, list_splitters, col_control_id,
+                list_column_split_rename, incremental, replace_changed, schema, merge_keys, validation,
+                parsed=(start_date, seconds)))
+
+    async def insert_excel_data_to_sqlite_table(self, _excel_path, _table_name, _sheet_name='',
+                                                _list_column_rename='', _table_split_name='',
+                                                _list_col_to_split='', _list_splitters='', _col_control_id='',
+                                                _list_column_split_rename='', _skiprows='', _schema=''):
+        """
+        async version of Pipeline.insert_excel_data_to_sqlite_table for one file, same params
+        :return: the stats of the insert (see Pipeline.insert_DataFrame_to_sqlite_table)
+        """
+        return await self._load(
+            functools.partial(Pipeline._read_excel, _excel_path, _sheet_name, _list_column_rename, _skiprows,
+                              self.pipeline.excel_engine),
+            _excel_path, _table_name, _table_split_name, _list_col_to_split, _list_splitters, _col_control_id,
+            _list_column_split_rename, _schema)
+
+    async def insert_csv_data_to_sqlite_table(self, _csv_path, _table_name, _list_column_rename='',
+                                              _table_split_name='', _list_col_to_split='', _list_splitters='',
+                                              _col_control_id='', _list_column_split_rename='', _schema=''):
+        """
+        async version of Pipeline.insert_csv_data_to_sqlite_table for one file, same params
+        :return: the stats of the insert (see Pipeline.insert_DataFrame_to_sqlite_table)
+        """
+        return await self._load(
+            functools.partial(Pipeline._read_csv, _csv_path, _list_column_rename),
+            _csv_path, _table_name, _table_split_name, _list_col_to_split, _list_splitters, _col_control_id,
+            _list_column_split_rename, _schema)
+
+    async def insert_json_data_to_sqlite_table(self, _json_path, _table_name, _list_column_rename='',
+                                               _table_split_name='', _list_col_to_split='', _list_splitters='',
+                                               _col_control_id='', _list_column_split_rename='', _lines=False,
+                                               _schema=''):
+        """
+        async version of Pipeline.insert_json_data_to_sqlite_table for one file, same params
+        :return: the stats of the insert (see Pipeline.insert_DataFrame_to_sqlite_table)
+        """
+        return await self._load(
+            functools.partial(Pipeline._read_json, _json_path, _list_column_rename, _lines),
+            _json_path, _table_name, _table_split_name, _list_col_to_split, _list_splitters, _col_control_id,
+            _list_column_split_rename, _schema)
+
+    async def insert_DataFrame_to_sqlite_table(self, df, table_name, source, **kwargs):
+        """
+        async version of Pipeline.insert_DataFrame_to_sqlite_table, the dataframe is queued for the writer
+        and written atomically unless atomic=False is passed
+        """
+        kwargs.setdefault('atomic', True)
+        await self.start()
+        async with self._slots:
+            return await self._write(functools.partial(
+                self.pipeline.insert_DataFrame_to_sqlite_table, df, table_name, source, **kwargs))
+
+    async def fetch_dataframe_using_query(self, string='', file_path='', table_name=''):
+        """
+        async version of Pipeline.fetch_dataframe_using_query, the query runs in the parse executor on its
+        thread's own connection so reads don't wait behind the queued writes (use the WAL journal mode
+        to read while a write is committing)
+        """
+        return await self._parse(functools.partial(self.pipeline.fetch_dataframe_using_query, string, file_path,
+                                                   table_name))
+
+
+class ShardedPipeline:
+    """
+    sharded layout for the hosts loading many sources at once: each table, or group of tables (shard_groups), is
+    written in its own database file of shard_dir by its own Pipeline, so the processes or threads loading
+    different shards never wait for each other's write lock. Each shard keeps its own control_table, its rows are
+    copied to the control_table of the catalog database (db_path) after every load, along with the shard of each
+    table in shard_map. The queries run on the catalog, the shards they read are ATTACHed on the fly so they are
+    written as if every table was in the same database
+        with ShardedPipeline('catalog.db', 'shards', shard_groups={'refunds': 'sales'}) as pipeline:
+            pipeline.insert_csv_data_to_sqlite_table(_csv_path='sales.csv', _table_name='sales')
+            pipeline.insert_excel_data_to_sqlite_table('customers.yaml')
+            df = pipeline.fetch_dataframe_using_query('SELECT * FROM sales_latest JOIN customers_latest USING (cid)')
+    The split table of a load goes in the shard of its table, and the tables aligned together (_update_upload_ids)
+    must share a shard. A query can read at most as many shards as sqlite can attach (10 by default)
+    """
+    def __init__(self, db_path, shard_dir, shard_groups=None, **pipeline_kwargs):
+        """
+        :param db_path: the path of the catalog database -> str
+        :param shard_dir: the folder of the shard files, <group>.db -> str
+        :param shard_groups: the shard of the tables not in their own one {table_name: group} -> dict
+        :param pipeline_kwargs: passed to the Pipeline of the catalog and of each shard (pragmas, timeout, ...)
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.shard_groups = dict(shard_groups) if shard_groups else {}
+        self.pipeline_kwargs = pipeline_kwargs
+        self.catalog = Pipeline(db_path, **pipeline_kwargs)
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        con = self.catalog._get_connection()
+        con.execute(CONTROL_TABLE_DDL)
+        con.execute(SHARD_MAP_DDL)
+        con.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        closes the connections of the catalog and of the shards
+        """
+        with self._shards_lock:
+            shards = list(self._shards.values())
+        for shard in shards:
+            shard.close()
+        self.catalog.close()
+
+    # Shards
+    def _get_shard_path(self, group):
+        return os.path.join(self.shard_dir, group + '.db')
+
+    def _find_group(self, table_name):
+        """
+        :return: the shard holding the table, its latest view or its quarantine table, according to shard_map, None
+        if unknown
+        """
+        names = [table_name] + [table_name[:-len(suffix)] for suffix in ('_latest', QUARANTINE_SUFFIX)
+                                if table_name.endswith(suffix)]
+        for name in names:
+            row = self.catalog._get_connection().execute(
+                'SELECT shard FROM main.shard_map WHERE table_name = ?;', (name,)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def _get_group(self, table_name):
+        """
+        :return: the shard of the table: the one it is already in, else the one of shard_groups, else its own
+        """
+        return self._find_group(table_name) or self.shard_groups.get(table_name, table_name)
+
+    def shard(self, table_name):
+        """
+        :return: the Pipeline writing the shard of the table -> Pipeline object
+        """
+        group = self._get_group(table_name)
+        with self._shards_lock:
+            if group not in self._shards:
+                self._shards[group] = Pipeline(self._get_shard_path(group), **self.pipeline_kwargs)
+            return self._shards[group]
+
+    def _sync_catalog(self, table_name):
+        """
+        replaces the control_table rows of the tables of the shard in the catalog with the ones of the shard and
+        records their shard in shard_map. The catalog is attached to the shard connection for one short
+        transaction only, the loads themselves never lock it
+        """
+        group = self._get_group(table_name)
+        shard = self.shard(table_name)
+        con = shard._get_connection()
+        if not shard._check_if_table_exists('control_table'):
+            return
+        columns = ', '.join('"%s"' % row[1] for row in con.execute('PRAGMA main.table_info(control_table);'))
+        if con.in_transaction:
+            con.commit()
+        con.execute('ATTACH DATABASE ? AS catalog;', (self.catalog.db_path,))
+        try:
+            with shard.transaction():
+                con.execute('''INSERT OR REPLACE INTO catalog.shard_map (table_name, shard)
+                SELECT DISTINCT table_name, ? FROM main.control_table;''', (group,))
+                con.execute('''DELETE FROM catalog.control_table
+                WHERE table_name IN (SELECT table_name FROM catalog.shard_map WHERE shard = ?);''', (group,))
+                con.execute('INSERT INTO catalog.control_table (%s) SELECT %s FROM main.control_table;'
+                            % (columns, columns))
+        finally:
+            con.execute('DETACH DATABASE catalog;')
+
+    def _attach_shard(self, group):
+        """
+        attaches the shard file to the catalog connection of the current thread as shard_<group>, the shard
+        attached first is detached when sqlite can't attach more
+        :return: the schema name of the shard
+        """
+        con = self.catalog._get_connection()
+        schema = 'shard_' + group
+        attached = [row[1] for row in con.execute('PRAGMA database_list;') if row[1] not in ('main', 'temp')]
+        if schema not in attached:
+            if con.in_transaction:
+                con.commit()
+            if len(attached) >= con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+                con.execute('DETACH DATABASE "%s";' % attached[0])
+            con.execute('ATTACH DATABASE ? AS "%s";' % schema, (self._get_shard_path(group),))
+        return schema
+
+    def _attach_query_shards(self, query):
+        """
+        attaches the shards the query reads: the query is prepared (EXPLAIN) and each 'no such table' error
+        attaches the shard of the missing table until it prepares, the other errors are raised
+        """
+        con = self.catalog._get_connection()
+        attached = set()
+        while True:
+            try:
+                con.execute('EXPLAIN ' + query).close()
+                return
+            except sqlite3.OperationalError as e:
+                match = re.search(r'no such table: (?:\w+\.)?(\w+)', str(e))
+                group = self._find_group(match.group(1)) if match else None
+                if group is None or group in attached:
+                    raise
+                self._attach_shard(group)
+                attached.add(group)
+
+    # Writes, each one in the shard of its table followed by the copy of the shard control_table to the catalog
+    def _write(self, table_name, method, *args, **kwargs):
+        result = getattr(self.shard(table_name), method)(*args, **kwargs)
+        self._sync_catalog(table_name)
+        return result
+
+    def insert_DataFrame_to_sqlite_table(self, df, table_name, source, **kwargs):
+        """
+        see Pipeline.insert_DataFrame_to_sqlite_table
+        """
+        return self._write(table_name, 'insert_DataFrame_to_sqlite_table', df, table_name, source, **kwargs)
+
+    def insert_DataFrame_chunks_to_sqlite_table(self, chunks, table_name, source, **kwargs):
+        """
+        see Pipeline.insert_DataFrame_chunks_to_sqlite_table
+        """
+        return self._write(table_name, 'insert_DataFrame_chunks_to_sqlite_table', chunks, table_name, source,
+                           **kwargs)
+
+    def insert_files_from_folder_to_sqlite_tables(self, folder_path, sheet_name, table_name, **kwargs):
+        """
+        see Pipeline.insert_files_from_folder_to_sqlite_tables
+        """
+        return self._write(table_name, 'insert_files_from_folder_to_sqlite_tables', folder_path, sheet_name,
+                           table_name, **kwargs)
+
+    def _insert_file(self, method, yaml_file, kwargs):
+        """
+        runs the loader in the shard of each table, the entries of a yaml file are loaded one by one with the
+        args of the loader (_excel_path, _table_name, ...) since their tables may be in different shards
+        """
+        if yaml_file != '':
+            with open(yaml_file) as f:
+                yaml_dict = yaml.safe_load(f)['Pipeline_dict']
+            for i in range(len(yaml_dict['table_name'])):
+                entry = {'_' + key: values[i] for key, values in yaml_dict.items()}
+                self._write(entry['_table_name'], method, **entry, **kwargs)
+        if kwargs.get('_table_name', '') != '':
+            self._write(kwargs['_table_name'], method, **kwargs)
+
+    def insert_excel_data_to_sqlite_table(self, yaml_file='', **kwargs):
+        """
+        see Pipeline.insert_excel_data_to_sqlite_table
+        """
+        self._insert_file('insert_excel_data_to_sqlite_table', yaml_file, kwargs)
+
+    def insert_csv_data_to_sqlite_table(self, yaml_file='', **kwargs):
+        """
+        see Pipeline.insert_csv_data_to_sqlite_table
+        """
+        self._insert_file('insert_csv_data_to_sqlite_table', yaml_file, kwargs)
+
+    def insert_json_data_to_sqlite_table(self, yaml_file='', **kwargs):
+        """
+        see Pipeline.insert_json_data_to_sqlite_table
+        """
+        self._insert_file('insert_json_data_to_sqlite_table', yaml_file, kwargs)
+
+    def _update_upload_ids(self, table_name_list, by_reference=False):
+        """
+        see Pipeline._update_upload_ids, the tables must be in the same shard
+        """
+        groups = {self._get_group(table_name) for table_name in table_name_list}
+        if len(groups) > 1:
+            raise ValueError('the tables aligned together must be in the same shard: %s' % ', '.join(table_name_list))
+        return self._write(table_name_list[0], '_update_upload_ids', table_name_list, by_reference)
+
+    def apply_retention(self, table_name, **kwargs):
+        """
+        see Pipeline.apply_retention, runs in the shard of each table
+        :return: the list of the deleted control_ids
+        """
+        deleted = []
+        for table_name in table_name if isinstance(table_name, list) else [table_name]:
+            deleted.extend(self._write(table_name, 'apply_retention', table_name, **kwargs))
+        return deleted
+
+    def diff_uploads(self, table_name, key_columns, **kwargs):
+        """
+        see Pipeline.diff_uploads, runs in the shard of the table
+        """
+        return self.shard(table_name).diff_uploads(table_name, key_columns, **kwargs)
+
+    def export_snapshot(self, path, table_name, **kwargs):
+        """
+        see Pipeline.export_snapshot, runs in the shard of the table
+        """
+        return self.shard(table_name).export_snapshot(path, table_name, **kwargs)
+
+    def import_snapshot(self, path, table_name='', **kwargs):
+        """
+        see Pipeline.import_snapshot, runs in the shard of the table
+        """
+        table_name = table_name or Pipeline._read_snapshot(path)[1]['table_name']
+        return self._write(table_name, 'import_snapshot', path, table_name, **kwargs)
+
+    # Reads, on the catalog with the shards they need attached
+    def fetch_dataframe_using_query(self, string='', file_path='', table_name='', **kwargs):
+        """
+        see Pipeline.fetch_dataframe_using_query, control_table is the one of the catalog listing every upload
+        """
+        query = self.catalog._get_query(string, file_path, table_name)
+        if query is None:
+            return None
+        self._attach_query_shards(query)
+        return self.catalog.fetch_dataframe_using_query(query, **kwargs)
+
+    def export_query_to_file(self, path, string='', file_path='', table_name='', **kwargs):
+        """
+        see Pipeline.export_query_to_file
+        """
+        query = self.catalog._get_query(string, file_path, table_name)
+        self._attach_query_shards(query)
+        return self.catalog.export_query_to_file(path, query, **kwargs)
+
+
+class PipelineRunner:
+    """
+    runs a pipeline spec: a yaml file listing steps and the steps they depend on. The steps whose dependencies
+    are done run concurrently: the sources are parsed in parallel by workers threads and written one after the
+    other by the writer of an AsyncPipeline. A step fails alone, the steps depending on it are cancelled and
+    the others go on
+        database: data.db
+        workers: 4
+        incremental: true           # the unchanged files are skipped, and the steps depending only on skipped ones
+        metrics: true               # optional, profiles the run and writes it to run_metrics (see Pipeline.profile)
+        trace_sql: false
+        steps:
+          - name: sales
+            type: csv               # csv, excel or json: loads the file at path in table_name
+            path: data/sales.csv
+            table_name: sales
+            chunksize: 100000       # optional, the args of insert_*_data_to_sqlite_table without their _
+            merge_keys: [sale_id]
+            validation:             # optional, the failing rows go to sales_quarantine, see _validate_dataframe
+              sale_id: {not_null: true, unique: true}
+              date: {type: date}
+              amount: {type: float, min: 0}
+          - name: customers
+            type: excel
+            path: data/customers.xlsx
+            sheet_name: clients
+            table_name: customers
+            list_col_to_split: [tags]
+            list_splitters: [';']
+            table_split_name: customers_tags
+          - name: align
+            type: align             # see Pipeline._update_upload_ids, depends on the steps loading its tables
+            tables: [sales, customers]
+            by_reference: true
+          - name: sales_by_customer
+            type: sql               # runs query (or the script at file_path), its result is inserted as a new
+            depends_on: [align]     # upload of table_name if given
+            query: SELECT customer, sum(amount) AS amount FROM sales_latest GROUP BY customer
+            table_name: sales_by_customer
+    """
+    SOURCE_TYPES = ('csv', 'excel', 'json')
+    STEP_TYPES = SOURCE_TYPES + ('align', 'sql')
+
+    def __init__(self, spec, db_path='', workers=''):
+        """
+        :param spec: the path of the yaml spec, or the spec itself -> str or dict
+        :param db_path: the database, the one of the spec if '' -> str
+        :param workers: the number of files parsed at the same time, the one of the spec (4 by default) if '' -> int
+        """
+        if isinstance(spec, str):
+            with open(spec) as f:
+                spec = yaml.safe_load(f)
+        self.spec = spec
+        self.db_path = db_path or spec.get('database', '')
+        if self.db_path == '':
+            raise ValueError('the spec has no database and no db_path was given')
+        self.workers = workers or spec.get('workers', 4)
+        self.incremental = spec.get('incremental', False)
+        self.replace_changed = spec.get('replace_changed', False)
+        self.steps = {}
+        for step in spec['steps']:
+            if 'name' not in step or step.get('type') not in self.STEP_TYPES:
+                raise ValueError('each step needs a name and a type among %s: %s' % (', '.join(self.STEP_TYPES), step))
+            if step['name'] in self.steps:
+                raise ValueError('two steps are named %s' % step['name'])
+            self.steps[step['name']] = step
+        self.graph = self._build_graph()
+
+    def _build_graph(self):
+        """
+        :return: the dependencies of each step {name: [names]}, the explicit depends_on ones and, for an align
+        step, the steps loading its tables. Raises ValueError on an unknown dependency or a cycle
+        """
+        loaded_by = collections.defaultdict(list)
+        for name, step in self.steps.items():
+            if step['type'] in self.SOURCE_TYPES or step.get('table_name'):
+                for table_name in (step.get('table_name'), step.get('table_split_name')):
+                    if table_name:
+                        loaded_by[table_name].append(name)
+        graph = {}
+        for name, step in self.steps.items():
+            dependencies = list(step.get('depends_on', []))
+            if step['type'] == 'align':
+                dependencies += [source for table_name in step['tables'] for source in loaded_by[table_name]]
+            for dependency in dependencies:
+                if dependency not in self.steps:
+                    raise ValueError('the step %s depends on an unknown step: %s' % (name, dependency))
+            graph[name] = list(dict.fromkeys(dependencies))
+        self._topological_order(graph)
+        return graph
+
+    @staticmethod
+    def _topological_order(graph):
+        """
+        :param graph: the dependencies of each step {name: [names]} -> dict
+        :return: the step names, each one after its dependencies
+        """
+        order = []
+        remaining = {name: set(dependencies) for name, dependencies in graph.items()}
+        while remaining:
+            ready = [name for name, dependencies in remaining.items() if not dependencies - set(order)]
+            if not ready:
+                raise ValueError('the steps depend on each other: %s' % ', '.join(remaining))
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+        return order
+
+    async def _run_step(self, pipeline, step):
+        """
+        :param pipeline: the AsyncPipeline writing in the database -> AsyncPipeline object
+        :param step: the step of the spec -> dict
+        :return: 'done', or 'skipped' if the step had nothing to do
+        """
+        type_ = step['type']
+        if type_ in self.SOURCE_TYPES:
+            path = step['path']
+            rename = step.get('list_column_rename', '')
+            if type_ == 'csv':
+                read = functools.partial(Pipeline._read_csv, path, rename, step.get('chunksize', ''))
+            elif type_ == 'excel':
+                read = functools.partial(Pipeline._read_excel, path, step.get('sheet_name', ''), rename,
+                                         step.get('skiprows', ''), step.get('engine', pipeline.pipeline.excel_engine))
+            else:
+                read = functools.partial(Pipeline._read_json, path, rename, step.get('lines', False),
+                                         step.get('chunksize', ''))
+            stats = await pipeline._load(
+                read, path, step['table_name'], step.get('table_split_name', ''), step.get('list_col_to_split', ''),
+                step.get('list_splitters', ''), step.get('col_control_id', ''),
+                step.get('list_column_split_rename', ''), step.get('schema', ''),
+                step.get('incremental', self.incremental), step.get('replace_changed', self.replace_changed),
+                step.get('merge_keys', ''), step.get('validation', ''))
+            return 'skipped' if stats is None else 'done'
+        if type_ == 'align':
+            await pipeline._write(functools.partial(pipeline.pipeline._update_upload_ids, step['tables'],
+                                                    step.get('by_reference', False)))
+            return 'done'
+        if step.get('table_name'):
+            df = await pipeline.fetch_dataframe_using_query(step.get('query', ''), step.get('file_path', ''))
+            await pipeline.insert_DataFrame_to_sqlite_table(df, step['table_name'], step['name'],
+                                                            schema=step.get('schema', ''))
+        else:
+            await pipeline._write(functools.partial(pipeline.pipeline.execute_sql, step.get('query', ''),
+                                                    step.get('file_path', '')))
+        return 'done'
+
+    async def run_async(self):
+        """
+        runs the steps of the spec, each one as soon as its dependencies are done
+        :return: {name: {'status': 'done', 'skipped', 'failed' or 'cancelled', 'seconds': float}}
+        """
+        results = {}
+        tasks = {}
+
+        async def run(name):
+            statuses = [await tasks[dependency] for dependency in self.graph[name]]
+            start = time.perf_counter()
+            if any(status in ('failed', 'cancelled') for status in statuses):
+                status = 'cancelled'
+            elif statuses and self.incremental and self.steps[name]['type'] not in self.SOURCE_TYPES and all(
+                    status == 'skipped' for status in statuses):
+                status = 'skipped'
+            else:
+                try:
+                    status = await self._run_step(pipeline, self.steps[name])
+                except Exception as e:
+                    print('echec de l etape %s: %r' % (name, e))
+                    status = 'failed'
+            results[name] = {'status': status, 'seconds': time.perf_counter() - start}
+            return status
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            async with AsyncPipeline(self.db_path, max_pending=self.workers, parse_executor=executor) as pipeline:
+                if self.spec.get('metrics', False):
+                    profile = pipeline.pipeline.profile(self.spec.get('run_id', ''), self.spec.get('trace_sql', False),
+                                                        persist=True)
+                else:
+                    profile = contextlib.nullcontext()
+                with profile:
+                    for name in self._topological_order(self.graph):
+                        tasks[name] = asyncio.ensure_future(run(name))
+                    await asyncio.gather(*tasks.values())
+        for name in self.steps:
+            print('%-30s %-10s %.2fs' % (name, results[name]['status'], results[name]['seconds']))
+        return results
+
+    def run(self):
+        """
+        runs the steps of the spec, see run_async
+        """
+        return asyncio.run(self.run_async())
+
+
+def main(argv=None):
+    """
+    command line entry point: python -m pipeline run spec.yaml [--db data.db] [--workers 8]
+    :return: the exit code, 1 if a step failed or was cancelled
+    """
+    parser = argparse.ArgumentParser(prog='python -m pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='runs the steps of a pipeline spec (see PipelineRunner)')
+    run.add_argument('spec', help='the path of the yaml spec')
+    run.add_argument('--db', default='', help='the database, the one of the spec by default')
+    run.add_argument('--workers', type=int, default=0, help='the number of files parsed at the same time')
+    args = parser.parse_args(argv)
+    results = PipelineRunner(args.spec, args.db, args.workers).run()
+    return int(any(result['status'] in ('failed', 'cancelled') for result in results.values()))
+
 
+if __name__ == '__main__':
+    sys.exit(main())